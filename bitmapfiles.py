@@ -1,13 +1,87 @@
-from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+
+from PIL import Image, ImageChops
 
 DEBUG = False
+SPRITE_LIMIT = 2000  # finished sprites kept, about 160KB each
+
+# Caches shared by all threads. An entry is a Future while the first
+# thread to miss on it makes it, then the finished value, which is never
+# changed afterwards.
+bitmaps = {}  # texture -> loaded bitmap
+sprites = {}  # (texture, cx, cy) -> crop of the bitmap
+# extract_sprite arguments -> finished sprite, the SPRITE_LIMIT most
+# recently used
+extracted = OrderedDict()
+evict_lock = threading.Lock()
+# extract_sprite arguments -> finished sprite made by another process, over
+# the shared memory of a spritestore.SpriteStore
+shared = {}
+
+CLEAR_TILE = Image.new(mode="RGBA", size=(200, 200), color=(0, 0, 0, 0))
+
+
+def once(cache, key, make, limit=None):
+    """cache[key], made by make() the first time it is asked for.
+
+    A hit is a dict lookup without a lock. Threads that miss on the same
+    key wait for the one that claimed it, threads that miss on different
+    keys make them in parallel. A failure is not cached.
+
+    With a limit, cache is an OrderedDict kept to the limit most recently
+    used entries. A hit moves its entry to the end, which OrderedDict does
+    atomically, and only evicting takes a lock."""
+    value = cache.get(key)
+    if value is None:
+        claim = Future()
+        value = cache.setdefault(key, claim)
+        if value is claim:
+            try:
+                value = make()
+            except BaseException as e:
+                cache.pop(key, None)
+                claim.set_exception(e)
+                raise
+            cache[key] = value
+            claim.set_result(value)
+            if limit:
+                with evict_lock:
+                    while len(cache) > limit:
+                        cache.popitem(last=False)
+            return value
+    elif limit:
+        try:
+            cache.move_to_end(key)
+        except KeyError:
+            pass  # evicted meanwhile, the value is still good
+    if isinstance(value, Future):
+        return value.result()
+    return value
 
-bitmaps = {}
-sprites = {}
+
+def load_bitmap(texture):
+    # Loaded up front, so threads can crop it at the same time
+    bitmap = Image.open(rf".\unxnb\{texture}.png")
+    bitmap.load()
+    return bitmap
 
 
 def extract_sprite(texture, cx, cy, sx, sy, ox, oy, color):
-    global bitmaps, sprites
+    """The 200x200 sprite at cx, cy of a texture, tinted by color and
+    moved by ox, oy. Thread safe: each sprite is made once and the same
+    image returned after, so callers must not change it."""
+    key = (texture, cx, cy, sx, sy, ox, oy, color)
+    sprite = shared.get(key)
+    if sprite is not None:
+        return sprite
+    return once(extracted, key,
+        lambda: make_sprite(texture, cx, cy, sx, sy, ox, oy, color),
+        SPRITE_LIMIT)
+
+
+def make_sprite(texture, cx, cy, sx, sy, ox, oy, color):
     if DEBUG:
         import os
         debug_count = 0
@@ -15,23 +89,10 @@ def extract_sprite(texture, cx, cy, sx, sy, ox, oy, color):
             f"{debug_count:0>3} texture:{texture}, cx:{cx}, cy:{cy}"
             f" sx:{sx}, sy:{sy}, ox:{ox}, oy:{oy}, color:{color}")
 
-    if texture not in bitmaps:
-        bitmaps[texture] = Image.open(rf".\unxnb\{texture}.png")
-
-    # multi level dictionary
-    d = sprites
-    n = 0
-    for k in (texture, cx, cy):
-        n += 1
-        try:
-            d = d[k]
-        except KeyError:
-            if n < 3:
-                d[k] = {}
-                d = d[k]
-            else:
-                d[k] = bitmaps[texture].crop((cx, cy, cx + sx, cy + sy))
-    sprite = sprites[texture][cx][cy]
+    def crop():
+        bitmap = once(bitmaps, texture, lambda: load_bitmap(texture))
+        return bitmap.crop((cx, cy, cx + sx, cy + sy))
+    sprite = once(sprites, (texture, cx, cy), crop)
 
     if DEBUG:
         fn = rf".\debug\{debug_count:0>3}-s1.png"
@@ -120,3 +181,66 @@ def extract_sprite(texture, cx, cy, sx, sy, ox, oy, color):
             sprite.save(fn)
 
     return sprite
+
+
+def compose_tile(sprites):
+    """Compose the 200x200 sprites of one tile, bottom first.
+
+    Returns (image, coverage): the sprites pasted in turn onto a cleared
+    tile, and how much of whatever is below the tile they hide. Pasting
+    both with paste_tile gives what pasting each sprite in turn gives, to
+    within rounding, so a composed tile can be reused anywhere."""
+    image = Image.new(mode="RGBA", size=(200, 200), color=(0, 0, 0, 0))
+    coverage = Image.new(mode="L", size=(200, 200), color=0)
+    for sprite in sprites:
+        alpha = sprite.getchannel("A")
+        image.paste(sprite, (0, 0), alpha)
+        coverage.paste(255, (0, 0), alpha)
+    return image, coverage
+
+
+def paste_tile(canvas, image, coverage, x, y):
+    """Paste a tile from compose_tile onto canvas at x, y."""
+    box = (x, y, x + 200, y + 200)
+    # Pasting a color with a mask treats clear pixels differently from
+    # pasting an image, so the clearing is done with an image
+    canvas.paste(CLEAR_TILE, box, coverage)
+    canvas.paste(ImageChops.add(canvas.crop(box), image), box)
+
+
+class ComposeCache:
+    """Bounded, thread safe cache of composed tiles keyed by their sprite
+    stack, a tuple of extract_sprite argument tuples in paste order.
+
+    extract is called with the arguments of each sprite on a miss, in
+    place of extract_sprite when given."""
+
+    def __init__(self, limit=2000, extract=None):
+        self.limit = limit
+        self.extract = extract or extract_sprite
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, stack, counts=None):
+        """The composed tile of stack. counts, a Counter, gets a hit or a
+        miss added for the caller's own tally."""
+        with self.lock:
+            composed = self.tiles.get(stack)
+            if composed is not None:
+                self.tiles.move_to_end(stack)
+                self.hits += 1
+                if counts is not None:
+                    counts["hits"] += 1
+                return composed
+            self.misses += 1
+        if counts is not None:
+            counts["misses"] += 1
+        # Compose outside the lock, two threads may both compose a stack
+        composed = compose_tile([self.extract(*sprite) for sprite in stack])
+        with self.lock:
+            self.tiles[stack] = composed
+            if len(self.tiles) > self.limit:
+                self.tiles.popitem(last=False)
+        return composed
@@ -0,0 +1,461 @@
+import argparse
+
+from db_config import get_connection
+from regiontiles import tileadjust_many
+from tilewriter import advisory_lock, LOCK_SCHEMA
+
+# Terrain layers of a tile that show on the map
+VISIBLE = "(mod(base, 2) <> 0 or mod(wall, 2) <> 0 or mod(door, 2) <> 0)"
+
+# Tables whose rows are merged under their natural key before the unique
+# indexes: (table, id column, natural key, [(child table, column)])
+DUPLICATES = [
+    ("regiontile", "rtno", "srno, tx, ty",
+        [("tilecomponent", "rtno"), ("tileannotate", "rtno"),
+        ("tiledestination", "rtno")]),
+    ("tilecomponent", "tcno", "rtno, color", [("componentterrain", "tcno")]),
+    ("componentterrain", "ctno", "tcno, terrainid", [("keepeffect", "ctno")]),
+]
+
+
+def merge_duplicates(cur, verbose=False):
+    """Merge the tiles, components and terrains stored more than once,
+    which loaders checking before inserting could do, into the one with
+    the lowest id. Their child rows move to it, and the tiles merged are
+    classified again and drawn again."""
+    sql = """\
+        create temporary table mergeid (
+            old integer primary key,
+            keep integer not null)
+        on commit drop
+        """
+    cur.execute(sql)
+    rtnos = set()
+    for table, pk, key, children in DUPLICATES:
+        sql = f"""\
+            insert into mergeid
+                (old, keep)
+            select {pk}, keep
+            from (
+                select {pk}, min({pk}) over (partition by {key}) as keep
+                from {table}) as t
+            where {pk} <> keep
+            """
+        cur.execute(sql)
+        if not cur.rowcount:
+            continue
+        if verbose:
+            print(f"Merging {cur.rowcount} duplicate {table} rows")
+        for child, column in children:
+            sql = f"""\
+                update {child} c
+                set {column} = m.keep
+                from mergeid m
+                where c.{column} = m.old
+                """
+            cur.execute(sql)
+        # The tiles the merged rows belong to
+        sql = {
+            "regiontile": """\
+                select keep as rtno
+                from mergeid
+                """,
+            "tilecomponent": """\
+                select tc.rtno
+                from mergeid m
+                inner join tilecomponent tc
+                    on tc.tcno = m.keep
+                """,
+            "componentterrain": """\
+                select tc.rtno
+                from mergeid m
+                inner join componentterrain ct
+                    on ct.ctno = m.keep
+                inner join tilecomponent tc
+                    on tc.tcno = ct.tcno
+                """,
+        }[table]
+        cur.execute(sql)
+        rtnos.update(row["rtno"] for row in cur.fetchall())
+        sql = f"""\
+            delete from {table} t
+            using mergeid m
+            where t.{pk} = m.old
+            """
+        cur.execute(sql)
+        cur.execute("truncate mergeid")
+    if rtnos:
+        sql = """\
+            update regiontile
+            set fingerprint = null,
+                generation = nextval('tilegeneration')
+            where rtno = any(%s)
+            """
+        cur.execute(sql, (sorted(rtnos),))
+        tileadjust_many(cur, rtnos)
+
+
+# (version, description, statements), applied in order, each version in a
+# transaction of its own. A statement is SQL or a function of the cursor
+# and the verbose flag of migrate().
+# Never change a version once released, add one.
+MIGRATIONS = [
+    (1, "Columns and tables the scripts used to add themselves", [
+        """\
+        create sequence if not exists tilegeneration
+        """,
+        """\
+        alter table regiontile
+        add column if not exists generation bigint not null default 0
+        """,
+        """\
+        alter table regiontile
+        add column if not exists fingerprint bigint
+        """,
+        """\
+        create table if not exists maprender (
+            srno integer primary key,
+            generation bigint not null,
+            layout character(64) not null,
+            tiles integer not null,
+            rendered timestamp not null default now())
+        """,
+        """\
+        alter table maprender
+        add column if not exists annotations character(64)
+        """,
+        """\
+        create table if not exists replayingest (
+            rino serial primary key,
+            replayhash character(64) not null unique,
+            replayname character varying,
+            moveno integer not null default 0,
+            byteoffset bigint not null default 0,
+            srno integer,
+            px integer,
+            py integer,
+            complete boolean not null default false,
+            updated timestamp not null default now())
+        """,
+    ]),
+    (2, "Indexes of the render queries and loader lookups", [
+        # The natural keys the loaders look tiles up by, which are only
+        # unique once the duplicates of the old loaders are merged. A
+        # database with duplicates failed this version, so it has not
+        # been applied anywhere they are left.
+        merge_duplicates,
+        """\
+        create unique index if not exists regiontile_tile
+        on regiontile (srno, tx, ty)
+        include (rtno, generation, fingerprint)
+        """,
+        """\
+        create unique index if not exists tilecomponent_color
+        on tilecomponent (rtno, color)
+        include (tcno)
+        """,
+        """\
+        create unique index if not exists componentterrain_terrain
+        on componentterrain (tcno, terrainid)
+        include (ctno)
+        """,
+        # The sprites of a terrain
+        """\
+        create index if not exists terraintexture_terrainid
+        on terraintexture (terrainid)
+        include (ttno)
+        """,
+        """\
+        create index if not exists texturebitmap_ttno
+        on texturebitmap (ttno)
+        include (texture, cx, cy, sx, sy, ox, oy)
+        """,
+        """\
+        create index if not exists bitmapsprites_sprite
+        on bitmapsprites (texture, cx, cy)
+        include (render)
+        """,
+        """\
+        create index if not exists tileannotate_rtno
+        on tileannotate (rtno)
+        include (line1, line2)
+        """,
+        """\
+        analyze regiontile, tilecomponent, componentterrain,
+            terraintexture, texturebitmap, bitmapsprites, tileannotate
+        """,
+    ]),
+    (3, "Visible on map column of componentterrain", [
+        f"""\
+        alter table componentterrain
+        add column if not exists visible boolean
+        generated always as {VISIBLE} stored
+        """,
+        """\
+        create index if not exists componentterrain_visible
+        on componentterrain (tcno)
+        include (terrainid)
+        where visible
+        """,
+        """\
+        analyze componentterrain
+        """,
+    ]),
+    (4, "Maps repaint new tiles, maprender no longer counts them", [
+        """\
+        alter table maprender
+        drop column if exists tiles
+        """,
+    ]),
+]
+
+
+def migrate(conn, verbose=False):
+    """Apply the migrations the database has not had yet. Safe to run
+    from several processes at once. Returns the versions applied."""
+    cur = conn.cursor()
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        advisory_lock(cur, LOCK_SCHEMA)
+        sql = """\
+            create table if not exists schemaversion (
+                version integer primary key,
+                description character varying not null,
+                applied timestamp not null default now())
+            """
+        cur.execute(sql)
+        sql = """\
+            select version
+            from schemaversion
+            where version = %s
+            """
+        cur.execute(sql, (version,))
+        if cur.rowcount:
+            conn.commit()
+            continue
+        if verbose:
+            print(f"Migration {version}: {description}")
+        try:
+            for sql in statements:
+                if callable(sql):
+                    sql(cur, verbose)
+                else:
+                    cur.execute(sql)
+        except Exception as e:
+            conn.rollback()
+            raise RuntimeError(
+                f"Migration {version} ({description}) failed: {e}") from e
+        sql = """\
+            insert into schemaversion
+                (version, description)
+            values (%s, %s)
+            """
+        cur.execute(sql, (version, description))
+        conn.commit()
+        applied.append(version)
+    return applied
+
+
+def pending(conn):
+    """The versions of MIGRATIONS the database has not had yet."""
+    cur = conn.cursor()
+    cur.execute("select to_regclass('schemaversion') as schemaversion")
+    applied = set()
+    if cur.fetchone()["schemaversion"]:
+        cur.execute("select version from schemaversion")
+        applied = {row["version"] for row in cur.fetchall()}
+    conn.commit()
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+def has_column(cur, table, column):
+    sql = """\
+        select column_name
+        from information_schema.columns
+        where table_name = %s
+        and column_name = %s
+        """
+    cur.execute(sql, (table, column))
+    return cur.rowcount > 0
+
+
+def visible_filter(cur):
+    """The filter of visible terrains, by the visible column once the
+    database has it."""
+    if has_column(cur, "componentterrain", "visible"):
+        return "ct.visible"
+    return VISIBLE.replace("mod(", "mod(ct.")
+
+
+def explain_queries(cur):
+    """The queries timed by --explain, as (name, sql, parameters), on the
+    region with the most tiles. Queries of columns the database does not
+    have yet are left out."""
+    sql = """\
+        select srno, count(*) as tiles
+        from regiontile
+        group by srno
+        order by count(*) desc
+        limit 1
+        """
+    cur.execute(sql)
+    region = cur.fetchone()
+    if region is None:
+        return []
+    srno = region["srno"]
+    sql = """\
+        select rt.rtno, rt.tx, rt.ty, tc.tcno, tc.color, ct.terrainid
+        from regiontile rt
+        inner join tilecomponent tc
+            on tc.rtno = rt.rtno
+        inner join componentterrain ct
+            on ct.tcno = tc.tcno
+        where rt.srno = %s
+        order by rt.rtno desc
+        limit 1
+        """
+    cur.execute(sql, (srno,))
+    tile = cur.fetchone()
+    if tile is None:
+        return []
+    sql = """\
+        select rtno
+        from regiontile
+        where srno = %s
+        and tx between %s and %s
+        and ty between %s and %s
+        """
+    cur.execute(sql, (srno, tile["tx"] - 3, tile["tx"] + 3,
+        tile["ty"] - 3, tile["ty"] + 3))
+    rtnos = [row["rtno"] for row in cur.fetchall()]
+    visible = visible_filter(cur)
+    generation = has_column(cur, "regiontile", "generation")
+    fingerprint = has_column(cur, "regiontile", "fingerprint")
+
+    queries = [
+        ("make maps.py sprite rows", f"""\
+            select rt.tx, rt.ty, bs.render, tc.color,
+                tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy
+            from regiontile as rt
+            inner join tilecomponent as tc
+                on tc.rtno = rt.rtno
+            inner join componentterrain as ct
+                on ct.tcno = tc.tcno
+            inner join terraintexture as tt
+                on tt.terrainid = ct.terrainid
+            inner join texturebitmap as tb
+                on tb.ttno = tt.ttno
+            inner join bitmapsprites as bs
+                on bs.texture = tb.texture
+                and bs.cx = tb.cx
+                and bs.cy = tb.cy
+            where rt.srno = %s
+            and {visible}
+            order by rt.tx, rt.ty, bs.render, tc.tcno, ct.ctno
+            """, (srno,), True),
+        ("make maps.py repaint tiles", """\
+            select rtno, tx, ty, generation
+            from regiontile
+            where srno = %s
+            """, (srno,), generation),
+        ("make maps.py annotations", """\
+            select rt.tx, rt.ty, ta.line1, ta.line2
+            from regiontile rt
+            inner join tileannotate ta
+                on ta.rtno = rt.rtno
+            where rt.srno = %s
+            order by rt.tx, rt.ty
+            """, (srno,), True),
+        ("transition view tiles", """\
+            select rt.tx, rt.ty, tc.tcno, tc.color, ct.terrainid,
+                ct.base, ct.wall, ct.door
+            from regiontile rt
+            inner join tilecomponent tc
+                on tc.rtno = rt.rtno
+            inner join componentterrain ct
+                on ct.tcno = tc.tcno
+            where rt.rtno = any(%s)
+            order by rt.rtno, tc.tcno, ct.ctno
+            """, (rtnos,), True),
+        ("loader region preload", """\
+            select rt.rtno, rt.tx, rt.ty, rt.fingerprint, tc.tcno, tc.color,
+                ct.terrainid, ct.base, ct.wall, ct.door
+            from regiontile rt
+            left join tilecomponent tc
+                on tc.rtno = rt.rtno
+            left join componentterrain ct
+                on ct.tcno = tc.tcno
+            where rt.srno = %s
+            order by rt.rtno, tc.tcno, ct.ctno
+            """, (srno,), fingerprint),
+        ("loader tile lookup", """\
+            select rtno
+            from regiontile
+            where srno = %s
+            and tx = %s
+            and ty = %s
+            """, (srno, tile["tx"], tile["ty"]), True),
+        ("loader component lookup", """\
+            select tcno
+            from tilecomponent
+            where rtno = %s
+            and color = %s
+            """, (tile["rtno"], tile["color"]), True),
+        ("loader terrain lookup", """\
+            select ctno
+            from componentterrain
+            where tcno = %s
+            and terrainid = %s
+            """, (tile["tcno"], tile["terrainid"]), True),
+    ]
+    return [(name, sql, prm)
+        for name, sql, prm, present in queries
+        if present]
+
+
+def explain(conn, runs=3):
+    """Best execution time in ms of each explain query over runs runs."""
+    cur = conn.cursor()
+    timings = {}
+    for name, sql, prm in explain_queries(cur):
+        best = None
+        for _ in range(runs):
+            cur.execute("explain (analyze, format json) " + sql, prm)
+            plan = cur.fetchone()["QUERY PLAN"][0]
+            ms = plan["Execution Time"]
+            if best is None or ms < best:
+                best = ms
+        timings[name] = best
+    conn.commit()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bring the database schema up to date')
+    parser.add_argument('--explain', action='store_true',
+        help='Time the render and loader queries before and after '
+            'migrating, with EXPLAIN ANALYZE')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    before = {}
+    if args.explain:
+        if pending(conn):
+            before = explain(conn)
+        else:
+            print("No migrations pending, timing the current schema")
+    applied = migrate(conn, verbose=True)
+    if not applied:
+        print("Schema is up to date")
+    if args.explain:
+        after = explain(conn)
+        print(f"{'query':<30} {'before ms':>10} {'after ms':>10}")
+        for name, ms in after.items():
+            was = f"{before[name]:.2f}" if name in before else "-"
+            print(f"{name:<30} {was:>10} {ms:>10.2f}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
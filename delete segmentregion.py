@@ -96,6 +96,13 @@ def main():
     cur.execute(sql, (srno,))
     print(f"  regiontile: {cur.rowcount} rows deleted")
 
+    # Delete the render state of make maps.py, if it has run
+    cur.execute("select to_regclass('maprender') as maprender")
+    if cur.fetchone()["maprender"]:
+        sql = "delete from maprender where srno = %s"
+        cur.execute(sql, (srno,))
+        print(f"  maprender: {cur.rowcount} rows deleted")
+
     # Delete segmentregion
     sql = "delete from segmentregion where srno = %s"
     cur.execute(sql, (srno,))
@@ -4,7 +4,9 @@ import tkinter as tk
 from tkinter.filedialog import askopenfilename
 from bs4 import BeautifulSoup
 
-from regiontiles import tileadjust
+from regiontiles import tileadjust_many
+from tilewriter import fingerprint, update_fingerprints
+from dbschema import migrate
 from db_config import get_connection
 
 
@@ -103,18 +105,22 @@ def process_region(sno, regiontag):
         cur.execute(sql, prm)
     srno = cur.fetchone()["srno"]
 
+    # Tiles are adjusted together when the region is committed
+    dirty = set()
     for tag in regiontag.find_all(recursive=False):
         if tag.name == "tile":
-            process_tile(srno, tag)
+            process_tile(srno, tag, dirty)
+    tileadjust_many(cur, dirty)
+    conn.commit()
 
 
-def process_tile(srno, tiletag):
+def process_tile(srno, tiletag, dirty):
     global conn, cur
     destinationdict, terrainlist = load_tile(tiletag)
     if (destinationdict
     or terrainlist):
         sql = """\
-            select rtno
+            select rtno, fingerprint
             from regiontile
             where srno = %s
             and tx = %s
@@ -127,11 +133,16 @@ def process_tile(srno, tiletag):
                 insert into regiontile
                     (srno, tx, ty)
                 values (%s, %s, %s)
-                returning rtno
+                returning rtno, fingerprint
                 """
             prm = (srno, tiletag["x"], tiletag["y"])
             cur.execute(sql, prm)
-        rtno = cur.fetchone()["rtno"]
+        row = cur.fetchone()
+        rtno = row["rtno"]
+        # The tile was reloaded unchanged, its components are all stored
+        if (terrainlist
+        and row["fingerprint"] == fingerprint(terrainlist)):
+            terrainlist = []
 
     if destinationdict:
         segmentid = destinationdict["destinationsegment"]
@@ -198,8 +209,19 @@ def process_tile(srno, tiletag):
                     """
                 prm = (tcno, terrainid)
                 cur.execute(sql, prm)
-        tileadjust(cur, rtno)
-    conn.commit()
+        dirty.add(rtno)
+
+        sql = """\
+            select ct.terrainid, tc.color
+            from tilecomponent tc
+            inner join componentterrain ct
+                on ct.tcno = tc.tcno
+            where tc.rtno = %s
+            """
+        prm = (rtno,)
+        cur.execute(sql, prm)
+        content = [(row["terrainid"], row["color"]) for row in cur.fetchall()]
+        update_fingerprints(cur, [(rtno, fingerprint(content))])
 
 
 def load_tile(tiletag):
@@ -294,4 +316,5 @@ if __name__ == "__main__":
     if soup:
         conn = get_connection()
         cur = conn.cursor()
+        migrate(conn)
         process_map()
@@ -1,235 +1,268 @@
 import os
-from operator import itemgetter
+import argparse
+import glob
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
 from PIL import Image, ImageTk
 
-import bitmapfiles
-from regiontiles import tileadjust
+import replaydecode
+import replaytrace
+import tileindex
+from regionview import RegionView
+from tilewriter import TileWriter, advisory_lock, LOCK_SEGMENT
+from dbschema import migrate
 from db_config import get_connection
 
+COORDS_SUFFIX = ".coords"
+TRACE_SUFFIX = ".trace.txt"
 
-def process_moves():
-    global trace, data, index, conn
-    move = 0
+conn = None
+cur = None
+writer = None
+tracer = None
+view = None
+index = None
+
+
+def apply_moves(log, restart=False, coords=(), prompt=True, match=True):
+    """Write the decoded moves of a replay to the database.
+
+    coords holds [sid, rid, px, py] for the start and each transition in
+    turn. Transitions past the end of coords are matched against the
+    stored tiles when match is on. They are prompted for with the best
+    match filled in, or when prompt is off take a unique match and end the
+    replay without one. Progress is checkpointed with every commit,
+    so an interrupted or cancelled replay resumes after its last committed
+    move. Returns True when the whole replay was applied."""
+    global tracer, writer, progress
     srno = None
     px = None
     py = None
-    for index in range(len(data) - 14):
-        if (data[index:index+4] != bytes.fromhex("00003D00")
-        or data[index+5] != 0x08):
-            continue
-        direction = data[index+4]
-        mask = data[index+6:index+14]
-        index += 14
-        move += 1
-
-        print(file=trace)
-        if mask == bytes.fromhex("FFFFFFFFFFFFFFFF"):
-            # Generate transition view and prompt for coordinates
-            transition_img = None
-            if srno is not None and px is not None:
-                transition_img = generate_transition_view(srno, px, py)
-            srxy = get_start_coords(transition_img)
+    start = 0
+    checkpoint = replay_checkpoint(log)
+    if not restart:
+        if checkpoint["complete"]:
+            print("Replay was already loaded, use --restart to load it again")
+            return True
+        if checkpoint["moveno"]:
+            start = checkpoint["moveno"]
+            srno = checkpoint["srno"]
+            px = checkpoint["px"]
+            py = checkpoint["py"]
+            print(f"Resuming after move {start}")
+            if srno is not None:
+                writer.load_region(srno)
+    progress = dict(checkpoint, moveno=start, complete=False)
+    writer.before_commit = save_checkpoint
+    writer.track_visible = prompt
+
+    data = None
+    if tracer.level >= replaytrace.BYTES:
+        data = replaydecode.open_replay(log.fn)
+    transition = sum(1 for i in range(start) if log.is_transition(i))
+
+    for move in log.moves(start):
+        direction = move.direction
+
+        if move.mask == replaydecode.TRANSITION_MASK:
+            # Commit the moves so far, the transition view reads them back
+            writer.flush()
+            suggestion = None
+            unique = False
+            if (transition >= len(coords)
+            and match):
+                suggestion, unique = match_transition(log, move)
+            if transition < len(coords):
+                srxy = coords[transition]
+            elif (unique
+            and not prompt):
+                srxy = suggestion
+                print("Coordinates matched from stored tiles")
+            elif prompt:
+                # Generate transition view and prompt for coordinates
+                transition_view = None
+                if srno is not None and px is not None:
+                    transition_view = generate_transition_view(srno, px, py)
+                srxy = get_start_coords(transition_view, suggestion)
+            else:
+                print(f"No coordinates for transition {transition + 1}"
+                    f" at move {move.move}, stopping this replay")
+                srxy = []
             if not srxy:
-                return
+                return False
+            transition += 1
             sid, rid, px, py = srxy
-            msg = f"move:{move} sid:{sid}, rid:{rid}, px:{px}, py:{py}" + \
+            msg = f"move:{move.move} sid:{sid}, rid:{rid}, px:{px}, py:{py}" + \
                 f" dir:{direction:2X}"
-            print(msg, file=trace)
             print(msg)
+            if tracer.level >= replaytrace.MOVES:
+                tracer.transition(move, sid, rid, px, py)
             srno = segment_region(sid, rid)
-            trace.flush()
+            if index is not None:
+                index.regions[srno] = (sid, rid)
+            progress.update(moveno=move.move, byteoffset=move.offset,
+                srno=srno, px=px, py=py)
+            writer.flush()
             # Skip process_tiles for transitions - the FFFFFFFF mask just signals
             # a region change, not actual tile data
             continue
         else:
             px += (direction & 0x0f) - 4
             py += (direction >> 4 & 0x0f) - 4
-            print(f"move:{move} px:{px} py:{py} dir:{direction:2X}"
-                f" m:{''.join(f'{b:02X}' for b in mask)}", file=trace)
-        trace.flush()
-        process_tiles(srno, mask, px, py)
-        conn.commit()
-
-
-def process_tiles(srno, mask, px, py):
-    global trace, data, index
-    ty = py - 3
-    for m in mask:
-        print(f"m:{m:02X} index:{index:06X}", file=trace)
-        tx = px - 3
-        for bit in (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80):
-            if m & bit == 0:
-                tx = tx + 1
-                continue
-
-            tiletype = data[index]
-            print(f"  tx:{tx} ty:{ty} type:{tiletype:02X}", end="", file=trace)
-            index += 1
-
-            if tiletype not in (
-                0x00, 0x02, 0x04, 0x05, 0x06, 0x07,
-                0x08, 0x0A, 0x0C, 0x0D, 0x0E, 0x0F,
-                0x12, 0x16, 0x17, 0x1A, 0x1E, 0x1F,
-                0x22, 0x26, 0x27, 0x2A, 0x2E, 0x2F,
-                0x45, 0x47, 0x4D, 0x4F,
-                0x57, 0x5F,
-                0x67, 0x6F
-            ):
-                print(file=trace)
-                trace.flush()
-                msg = f"Bad tiletype {tiletype:02X}: " + \
-                    " ".join(f"{x:02X}"
-                        for x in data[index:index + 20])
-                raise ValueError(msg)
-
-            if tiletype in (
-                0x00, 0x02, 0x08, 0x0A,
-                0x12, 0x1A,
-                0x22, 0x2A
-            ):
-                print(file=trace)
-                tx = tx + 1
-                continue
-            rtno = region_tile(srno, tx, ty)
-            terrcnt = data[index]
-            index += 1
-
-            print(f" count:{terrcnt:02X}", end="", file=trace)
-            terrainlist = load_terrainlist(tiletype, terrcnt)
-
-            terrainlist.sort(key=itemgetter(1, 0))  # sort color, terrainid
-            colorsave = None
-            for terrainid, color in terrainlist:
-                if (colorsave is None
-                or color != colorsave):
-                    tcno = tile_component(rtno, color)
-                    colorsave = color
-                component_terrain(tcno, terrainid)
-            tileadjust(cur, rtno)
-            tx = tx + 1
-        ty = ty + 1
-
-
-def load_terrainlist(tiletype, terrcnt):
-    global trace, data, index
-    terrainlist = []
-    for _ in range(terrcnt):
-        terrainid = int.from_bytes(
-            data[index:index+2],
-            byteorder="little")
-        index += 2
-        print(f" tid:{terrainid}", end="", file=trace)
-        color = "-"
-        if tiletype in (
-            0x0C, 0x0D, 0x0E, 0x0F,
-            0x1E, 0x1f,
-            0x2E, 0x2F,
-            0x4D, 0x4F,
-            0x5F,
-            0x6F
-        ):
-            color = data[index:index+4]
-            index += 4
-            if color == bytes.fromhex("FFFFFFFF"):
-                color = "-"
-            else:
-                color = ", ".join(f"{c}" for c in color)
-                print(f" color:{color}", end="", file=trace)
-        terrainlist.append([terrainid, color])
+            if tracer.level >= replaytrace.MOVES:
+                tracer.move(move, px, py)
+            if tracer.level >= replaytrace.BYTES:
+                end = (log.move_offset[move.move] if move.move < len(log)
+                    else len(data))
+                tracer.raw(move.offset, data[move.offset:end])
+        process_tiles(srno, move.tiles, px, py)
+        progress.update(moveno=move.move, byteoffset=move.offset,
+            srno=srno, px=px, py=py)
+        writer.end_move()
+    # A replay whose decoding stopped early stays incomplete, so a later
+    # run or --redecode carries on after its last applied move
+    progress["complete"] = log.error is None
+    writer.flush()
+    if log.error:
+        # The moves decoded before the bad one are kept
+        raise ValueError(log.error)
+    return True
+
+
+def replay_checkpoint(log):
+    """Return the ingestion checkpoint of a replay, creating it if needed."""
+    global conn, cur
+    sql = """\
+        select rino, moveno, byteoffset, srno, px, py, complete
+        from replayingest
+        where replayhash = %s
+        """
+    prm = (log.digest.hex(),)
+    cur.execute(sql, prm)
+    if not cur.rowcount:
+        sql = """\
+            insert into replayingest
+                (replayhash, replayname)
+            values (%s, %s)
+            returning rino, moveno, byteoffset, srno, px, py, complete
+            """
+        prm = (log.digest.hex(), os.path.basename(log.fn))
+        cur.execute(sql, prm)
+    checkpoint = cur.fetchone()
+    conn.commit()
+    return checkpoint
 
-    if tiletype in (
-        0x05, 0x0D,
-        0x45, 0x4d
-    ):
-        movecost = data[index]
-        index += 1
-        print(f" move:{movecost:02X}", end="", file=trace)
-    print(file=trace)
-    return terrainlist
 
+def save_checkpoint(cur):
+    """Record the last move of a flush, called before the flush commits."""
+    global progress
+    sql = """\
+        update replayingest
+        set moveno = %s, byteoffset = %s, srno = %s, px = %s, py = %s,
+            complete = %s, updated = now()
+        where rino = %s
+        """
+    prm = (progress["moveno"], progress["byteoffset"], progress["srno"],
+        progress["px"], progress["py"], progress["complete"], progress["rino"])
+    cur.execute(sql, prm)
 
-def generate_transition_view(srno, px, py):
-    """Generate a map image centered on the last position before a transition.
-    Returns the PIL Image object for display in the dialog."""
-    global conn
 
-    # Define view bounds (7x7 tiles centered on position)
-    tlx = px - 3
-    tly = py - 3
-    brx = px + 3
-    bry = py + 3
+def dry_run(log):
+    """Report the moves and tiles of a decoded replay without a database."""
+    def report():
+        print(f"  region {legs}: moves:{moves} tiles:{tiles}"
+            f" terrains:{terrains} distinct tiles:{len(positions)}")
+
+    legs = 0
+    moves = tiles = terrains = 0
+    positions = set()
+    px = py = 0
+    for move in log.moves():
+        if move.mask == replaydecode.TRANSITION_MASK:
+            if moves:
+                report()
+            legs += 1
+            moves = tiles = terrains = 0
+            positions = set()
+            px = py = 0
+            continue
+        moves += 1
+        px += (move.direction & 0x0f) - 4
+        py += (move.direction >> 4 & 0x0f) - 4
+        for tile in move.tiles:
+            if tile.terrainlist is None:
+                continue
+            tiles += 1
+            terrains += len(tile.terrainlist)
+            positions.add((px + tile.dx, py + tile.dy))
+    if moves:
+        report()
+    print(f"{len(log)} moves, {legs} transitions,"
+        f" {len(log.tile_type)} tiles, {len(log.terrain_id)} terrains")
+    if log.error:
+        print(f"Decoding stopped: {log.error}")
+
+
+def process_tiles(srno, tiles, px, py):
+    global tracer, writer
+    trace_tiles = tracer.level >= replaytrace.TILES
+    for tile in tiles:
+        tx = px + tile.dx
+        ty = py + tile.dy
+        if trace_tiles:
+            tracer.tile(tx, ty, tile)
+        if tile.terrainlist is None:
+            continue
+        writer.add_tile(srno, tx, ty, tile.terrainlist)
+
+
+def match_transition(log, move):
+    """Propose the coordinates after a transition by matching the tiles of
+    the moves that follow it against the stored regions.
+    Returns ([sid, rid, px, py] or None, unique)."""
+    global conn, writer, index
+    if index is None:
+        print("Building tile index")
+        index = tileindex.TileIndex(conn)
+        # Keep it up to date with the tiles this process writes from now
+        writer.written = index.update
+    # Move numbers start at 1, so move.move indexes the next move
+    grid = tileindex.moves_grid(
+        islice(log.moves(move.move), tileindex.MATCH_MOVES))
+    matches, unique = index.best(grid)
+    if not matches:
+        return None, False
+    votes, srno, px, py = matches[0]
+    sid, rid = index.regions[srno]
+    print(f"Best tile match: sid:{sid}, rid:{rid}, px:{px}, py:{py}"
+        f" ({votes} votes)")
+    return [sid, rid, px, py], unique
 
-    sql = """\
-        select rt.tx, rt.ty, bs.render, tc.color,
-            tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy
-        from regiontile as rt
-        inner join tilecomponent as tc
-            on tc.rtno = rt.rtno
-        inner join componentterrain as ct
-            on ct.tcno = tc.tcno
-        inner join terraintexture as tt
-            on tt.terrainid = ct.terrainid
-        inner join texturebitmap as tb
-            on tb.ttno = tt.ttno
-        inner join bitmapsprites as bs
-            on bs.texture = tb.texture
-            and bs.cx = tb.cx
-            and bs.cy = tb.cy
-        where rt.srno = %s
-        and (mod(ct.base, 2) <> 0
-        or mod(ct.wall, 2) <> 0
-        or mod(ct.door, 2) <> 0)
-        and rt.tx between %s and %s
-        and rt.ty between %s and %s
-        order by rt.tx, rt.ty, bs.render, tc.tcno
-        """
-    tss = conn.cursor()
-    tss.execute(sql, (srno, tlx, brx, tly, bry))
-
-    # Create image
-    sx = (brx - tlx + 1) * 110 + 90
-    sy = (bry - tly + 1) * 110 + 90
-    new = Image.new(mode="RGBA", size=(sx, sy), color=(0, 0, 0, 0))
-
-    while True:
-        ts = tss.fetchone()
-        if not ts:
-            break
-        x = (ts["tx"] - tlx) * 110
-        y = (ts["ty"] - tly) * 110
-        sprite = bitmapfiles.extract_sprite(
-            ts["texture"], ts["cx"], ts["cy"],
-            ts["sx"], ts["sy"], ts["ox"], ts["oy"], ts["color"]
-        )
-        box = (x, y, x + sprite.size[0], y + sprite.size[1])
-        new.paste(sprite, box, sprite)
 
-    # Crop off the extra padding
-    new = new.crop((0, 0, sx - 90, sy - 90))
+def generate_transition_view(srno, px, py):
+    """Start rendering the map centered on the last position before a
+    transition, from the tiles the writer holds for the region.
+    Returns a Future of the PIL Image for display in the dialog."""
+    global conn, writer, view
 
-    # Also save to file for reference
+    if view is None:
+        view = RegionView(conn)
     fn = r".\transition_view.png"
-    os.makedirs(os.path.dirname(fn), exist_ok=True)
-    new.save(fn)
-    print(f"Transition view saved to {fn} (centered on {px}, {py})")
-
-    return new
+    print(f"Transition view saving to {fn} (centered on {px}, {py})")
+    # 7x7 tiles centered on position
+    return view.view(writer.visible, px - 3, py - 3, px + 3, py + 3, fn)
 
 
-def get_start_coords(transition_img=None):
+def get_start_coords(transition_view=None, suggestion=None):
     result = []
-    is_first_prompt = transition_img is None
+    is_first_prompt = transition_view is None
 
     def validate_data():
         nonlocal result
         try:
-            sid, px, py, rid = entry.get().replace(" ", "").split(",")
-            result.append(int(sid))
-            result.append(int(rid))
-            result.append(int(px))
-            result.append(int(py))
+            result = parse_coords(entry.get())
         except ValueError:
             result = []
             entry.focus_set()
@@ -272,21 +305,35 @@ def get_start_coords(transition_img=None):
         title_label = tk.Label(root, text="Transition Detected", font=("TkDefaultFont", 12, "bold"))
         title_label.pack(pady=(10, 5))
 
-        # Scale and display the transition image
-        img_width, img_height = transition_img.size
-        max_size = 500
-        if img_width > max_size or img_height > max_size:
-            scale = min(max_size / img_width, max_size / img_height)
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            display_img = transition_img.resize((new_width, new_height), Image.LANCZOS)
-        else:
-            display_img = transition_img
+        def show_transition_img():
+            # The view renders in the background, show it once it is done
+            if not transition_view.done():
+                root.after(50, show_transition_img)
+                return
+            try:
+                transition_img = transition_view.result()
+            except Exception as e:
+                img_label.config(text=f"Map view failed: {e}")
+                return
+
+            # Scale and display the transition image
+            img_width, img_height = transition_img.size
+            max_size = 500
+            if img_width > max_size or img_height > max_size:
+                scale = min(max_size / img_width, max_size / img_height)
+                new_width = int(img_width * scale)
+                new_height = int(img_height * scale)
+                display_img = transition_img.resize((new_width, new_height), Image.LANCZOS)
+            else:
+                display_img = transition_img
 
-        photo = ImageTk.PhotoImage(display_img, master=root)
-        img_label = tk.Label(root, image=photo)
-        img_label.image = photo  # Keep reference to prevent garbage collection
+            photo = ImageTk.PhotoImage(display_img, master=root)
+            img_label.config(image=photo, text="")
+            img_label.image = photo  # Keep reference to prevent garbage collection
+
+        img_label = tk.Label(root, text="Rendering map...")
         img_label.pack(pady=5)
+        show_transition_img()
 
         img_caption = tk.Label(root, text="Map state immediately before this transition",
             fg="gray", font=("TkDefaultFont", 9, "italic"))
@@ -321,6 +368,12 @@ def get_start_coords(transition_img=None):
     label.pack(fill="x")
     entry = tk.Entry(root, justify='center')
     entry.pack(fill="x", padx=10)
+    if suggestion:
+        sid, rid, px, py = suggestion
+        entry.insert(0, f"{sid}, {px}, {py}, {rid}")
+        label = tk.Label(root, text="Filled in from the closest matching stored tiles",
+            fg="gray")
+        label.pack(fill="x")
     button = tk.Button(root, text="Submit", command=validate_data)
     button.pack(pady=5)
     entry.focus_set()
@@ -337,8 +390,46 @@ def get_start_coords(transition_img=None):
     return result
 
 
+def parse_coords(text):
+    """Parse "segment, x, y, region" into [sid, rid, px, py]."""
+    sid, px, py, rid = text.replace(" ", "").split(",")
+    return [int(sid), int(rid), int(px), int(py)]
+
+
+def read_coords(fn):
+    """Read the start and transition coordinates of a replay from its
+    sidecar file, one "segment, x, y, region" line each in replay order.
+    Blank lines and # comments are skipped."""
+    coordsfn = fn + COORDS_SUFFIX
+    coords = []
+    if not os.path.exists(coordsfn):
+        return coords
+    with open(coordsfn, "r") as file:
+        for lineno, line in enumerate(file, 1):
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            try:
+                coords.append(parse_coords(line))
+            except ValueError:
+                msg = f"{coordsfn} line {lineno}: expected segment, x, y, region"
+                raise ValueError(msg) from None
+    return coords
+
+
+def replay_files(paths):
+    """Expand directories to the .sr files in them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.sr"))))
+        else:
+            files.append(path)
+    return files
+
+
 def segment_region(sid, rid):
-    global conn, cur
+    global cur, writer
     sql = """\
         select sno
         from segment
@@ -351,6 +442,8 @@ def segment_region(sid, rid):
         raise ValueError(msg)
     sno = cur.fetchone()["sno"]
 
+    # Replays loading in parallel must not both create the region
+    advisory_lock(cur, LOCK_SEGMENT, sno)
     sql = """\
         select srno
         from segmentregion
@@ -369,77 +462,11 @@ def segment_region(sid, rid):
         prm = (sno, rid, f"region {rid}")
         cur.execute(sql, prm)
     srno = cur.fetchone()["srno"]
+    writer.load_region(srno)
     return srno
 
 
-def region_tile(srno, tx, ty):
-    global conn, cur
-    sql = """\
-        select rtno
-        from regiontile
-        where srno = %s
-        and tx = %s
-        and ty = %s
-        """
-    prm = (srno, tx, ty)
-    cur.execute(sql, prm)
-    if not cur.rowcount:
-        sql = """\
-            insert into regiontile
-                (srno, tx, ty)
-            values (%s, %s, %s)
-            returning rtno
-            """
-        prm = (srno, tx, ty)
-        cur.execute(sql, prm)
-    rtno = cur.fetchone()["rtno"]
-    return rtno
-
-
-def tile_component(rtno, color):
-    global conn, cur
-    sql = """\
-        select tcno
-        from tilecomponent
-        where rtno = %s
-        and color = %s
-        """
-    prm = (rtno, color)
-    cur.execute(sql, prm)
-    if not cur.rowcount:
-        sql = """\
-            insert into tilecomponent
-                (rtno, color)
-            values (%s, %s)
-            returning tcno
-            """
-        prm = (rtno, color)
-        cur.execute(sql, prm)
-    tcno = cur.fetchone()["tcno"]
-    return tcno
-
-
-def component_terrain(tcno, terrainid):
-    global conn, cur
-    sql = """\
-        select ctno
-        from componentterrain
-        where tcno = %s
-        and terrainid = %s
-        """
-    prm = (tcno, terrainid)
-    cur.execute(sql, prm)
-    if not cur.rowcount:
-        sql = """\
-            insert into componentterrain
-                (tcno, terrainid, base, wall, door)
-            values (%s, %s, 0, 0, 0)
-            """
-        prm = (tcno, terrainid)
-        cur.execute(sql, prm)
-
-
-def load_replay_file():
+def select_replay_file():
     root = tk.Tk()
     root.withdraw()
     fn = askopenfilename(
@@ -448,20 +475,139 @@ def load_replay_file():
         filetypes=[("Replay Files", "*.sr")]
         )
     root.destroy()  # Properly destroy the root to avoid tkinter conflicts
-    if fn:
-        print(fn, file=trace)
-        print(fn)
-        with open(fn, "rb") as file:
-            data = file.read()
-    else:
-        data = None
-    return data
+    return fn
 
 
-if __name__ == "__main__":
-    trace = open(r".\trace.txt", "w")
-    data = load_replay_file()
-    if data:
+def open_session(args):
+    """Set up the tracer, connection and writer of this process."""
+    global conn, cur, writer, tracer
+    trace_file = args.trace_file if args.jobs <= 1 else None
+    tracer = replaytrace.Tracer(replaytrace.LEVELS[args.trace],
+        args.trace_ring, trace_file)
+    if not args.dry_run:
         conn = get_connection()
         cur = conn.cursor()
-        process_moves()
+        migrate(conn)
+        writer = TileWriter(conn, args.flush_moves)
+
+
+def ingest_replay(fn, args):
+    """Decode and apply one replay. On error the replay is rolled back to
+    its last commit and the trace written before the error is re-raised."""
+    global conn, writer, tracer
+    print(fn)
+    log = replaydecode.decoded_replay(fn, args.redecode)
+    if args.dry_run:
+        dry_run(log)
+        return True
+    tracer.ring.clear()
+    try:
+        return apply_moves(log, args.restart, read_coords(fn),
+            not args.no_prompt and args.jobs <= 1, not args.no_match)
+    except Exception as e:
+        trace_fn = r".\trace.txt" if args.jobs <= 1 else fn + TRACE_SUFFIX
+        tracer.dump(trace_fn, e)
+        print(f"Trace written to {trace_fn}")
+        conn.rollback()
+        writer = TileWriter(conn, args.flush_moves)
+        if index is not None:
+            writer.written = index.update
+        raise
+
+
+def ingest_worker(fn, args):
+    """Worker process entry point, returns (completed, error)."""
+    if tracer is None:
+        open_session(args)
+    try:
+        return ingest_replay(fn, args), None
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load replay files into the database')
+    parser.add_argument('replay', nargs='*',
+        help='Replay files or directories of replay files to load '
+            '(default: pick one in a file dialog)')
+    parser.add_argument('--no-prompt', action='store_true',
+        help='Never prompt for coordinates, stop a replay at the first '
+            'transition its .coords file does not cover')
+    parser.add_argument('--no-match', action='store_true',
+        help='Do not match transitions against stored tiles, always '
+            'prompt for coordinates missing from the .coords file')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of replays to load in parallel processes, implies '
+            '--no-prompt (default: 1)')
+    parser.add_argument('--flush-moves', type=int, default=500,
+        help='Commit every N moves, 0 commits only at transitions '
+            'and the end of the replay (default: 500)')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Decode the replay and report tile counts without '
+            'writing to the database')
+    parser.add_argument('--redecode', action='store_true',
+        help='Decode the replay again instead of reusing the saved '
+            'decoded log')
+    parser.add_argument('--restart', action='store_true',
+        help='Load the replay from the first move, even if it was '
+            'loaded before')
+    parser.add_argument('--trace', choices=replaytrace.LEVELS,
+        default='tiles',
+        help='What to trace: off, moves, tiles or bytes (default: tiles). '
+            'The most recent records are written to trace.txt on error')
+    parser.add_argument('--trace-ring', type=int, default=10000,
+        help='Number of trace records kept for trace.txt (default: 10000)')
+    parser.add_argument('--trace-file',
+        help='Also write every trace record to this file, in binary '
+            'if it ends with .bin (read it with replaytrace.py)')
+    args = parser.parse_args()
+
+    if args.jobs > 1 and args.trace_file:
+        parser.error("--trace-file can not be used with --jobs")
+
+    if args.replay:
+        files = replay_files(args.replay)
+    else:
+        fn = select_replay_file()
+        files = [fn] if fn else []
+    if not files:
+        return
+
+    failed = []
+    if args.jobs > 1 and len(files) > 1:
+        # Each worker decodes and applies whole replays on its own
+        # connection, the region locks of TileWriter keep them apart
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            future_to_fn = {executor.submit(ingest_worker, fn, args): fn
+                for fn in files}
+            for future in as_completed(future_to_fn):
+                fn = future_to_fn[future]
+                completed, error = future.result()
+                if error:
+                    print(f"ERROR: {fn}: {error}")
+                if not completed:
+                    failed.append(fn)
+    else:
+        open_session(args)
+        for fn in files:
+            try:
+                if not ingest_replay(fn, args):
+                    failed.append(fn)
+            except Exception as e:
+                if len(files) == 1:
+                    raise
+                print(f"ERROR: {e}")
+                failed.append(fn)
+        tracer.close()
+        if view is not None:
+            view.close()
+
+    if len(files) > 1:
+        print(f"\nLoaded {len(files) - len(failed)} of {len(files)} replays.")
+        for fn in failed:
+            print(f"  not completed: {fn}")
+
+
+if __name__ == "__main__":
+    main()
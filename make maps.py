@@ -1,30 +1,66 @@
 import os
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import shutil
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import as_completed
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 
 import bitmapfiles
+import mapencoder
+import mappyramid
+import mapreport
+import mapschedule
+import pngstream
+import spritestore
+from dbschema import migrate
 from db_config import get_connection
 
 COORDS = True
-
-# Thread-safe lock for bitmapfiles cache access
-bitmap_lock = threading.Lock()
+FULL = False  # render every map from scratch
+OUTPUT = "png"  # png, pyramid or both
+BAND_ROWS = 0  # render PNGs in bands of this many tile rows, 0 = whole
+PNG_LEVEL = 6  # zlib level of PNGs, the same as PIL's default
+DRAFT_LEVEL = 1  # zlib level of PNGs in draft format
+REPAINT_LIMIT = 0.25  # repaint up to this share of the tiles, else render
+# Tiles whose sprites reach a tile, as pixel offsets in paste order
+NEIGHBOURS = [(dx, dy) for dx in (-110, 0, 110) for dy in (-110, 0, 110)]
 
 # Shared resources that are read-only after initialization
 font50 = None
 coord_template = None
 annotate_template = None
+tile_cache = None
+coord_images = {}  # (coordinate, axis) -> label
+annotation_images = {}  # (line1, line2) -> label
+fonts = {}  # size -> font
+fitted_fonts = {}  # text -> largest font it fits in
+store = None  # shared sprite store of a render process
+encoder = None  # saves the map images
+current = threading.local()  # stats, the MapStats of the map being drawn
+unrecorded = {}  # srno -> maprender row of a map the encoder is saving
+
+# Each thread pool or render process keeps up to TILE_CACHE_LIMIT composed
+# tiles and bitmapfiles.SPRITE_LIMIT sprites, about 400MB and 320MB by
+# default, plus the textures it has decoded
+TILE_CACHE_LIMIT = 2000  # composed tiles kept, about 200KB each
+BAND_TILE_CACHE = 200  # the default with --band-rows, about 40MB
+BAND_SPRITE_CACHE = 200  # the sprite default with --band-rows, about 32MB
+FONT = r"font\CommitMono-400-Regular.otf"
+OVERLAY_ROWS = 10  # tile rows of the annotation overlay written at a time
+MANIFEST = r".\newmaps\manifest.json"  # srno -> digest of the last render
 
 
 def init_shared_resources():
     """Initialize shared resources used by all threads."""
-    global font50, coord_template, annotate_template
+    global font50, coord_template, annotate_template, tile_cache
 
-    font50 = ImageFont.truetype(r"font\CommitMono-400-Regular.otf", 50)
+    font50 = load_font(50)
 
     if COORDS:
         coord_template = Image.new('RGBA', (110, 110), (255, 255, 255, 255))
@@ -38,16 +74,648 @@ def init_shared_resources():
 
     annotate_template = Image.new('RGBA', (110, 110), (255, 255, 0, 192))
 
+    # Composed tiles are shared by all regions and threads
+    tile_cache = bitmapfiles.ComposeCache(TILE_CACHE_LIMIT)
+
+
+def init_process(settings, store_name, store_index):
+    """Set up a render process: the settings of the parent, which a
+    spawned process does not inherit, and the shared sprite store."""
+    global COORDS, FULL, OUTPUT, BAND_ROWS, PNG_LEVEL, TILE_CACHE_LIMIT
+    global store, encoder
+    (COORDS, FULL, OUTPUT, BAND_ROWS, PNG_LEVEL, TILE_CACHE_LIMIT,
+        bitmapfiles.SPRITE_LIMIT, image_format) = settings
+    init_shared_resources()
+    # The processes themselves overlap composing and encoding
+    encoder = mapencoder.Encoder(image_format, PNG_LEVEL, workers=0)
+    store = spritestore.SpriteStore.attach(store_name, store_index)
+    store.install()
+
+
+def stats():
+    """MapStats of the map this thread is drawing."""
+    mapstats = getattr(current, "stats", None)
+    if mapstats is None:
+        mapstats = current.stats = mapreport.MapStats()
+    return mapstats
+
+
+def paste_stack(new, stack, x, y):
+    """Paste the sprite stack of one tile at x, y."""
+    mapstats = stats()
+    if len(stack) == 1:
+        # A single sprite is cheaper to paste than a composed tile
+        cached = (stack[0] in bitmapfiles.shared
+            or stack[0] in bitmapfiles.extracted)
+        mapstats.caches["sprite"]["hits" if cached else "misses"] += 1
+        with mapstats.stage("sprites"):
+            sprite = bitmapfiles.extract_sprite(*stack[0])
+            new.paste(sprite, (x, y), sprite)
+        return
+    with mapstats.stage("compose"):
+        image, coverage = tile_cache.get(stack, mapstats.caches["tile"])
+    with mapstats.stage("paste"):
+        bitmapfiles.paste_tile(new, image, coverage, x, y)
+
+
+def tile_position(tx, ty, xadj, yadj):
+    """Pixel position of the sprites of a tile on the map image."""
+    xindex = 0
+    while tx > xadj[xindex][1]:
+        xindex += 1
+    yindex = 0
+    while ty > yadj[yindex][1]:
+        yindex += 1
+    return (tx + xadj[xindex][2]) * 110, (ty + yadj[yindex][2]) * 110
+
+
+def sprite_rows(conn, srno, rtnos=None, stream=False):
+    """Cursor over the visible sprites of a region, or of the rtnos of a
+    region, in paste order. A stream cursor returns the rows a batch at a
+    time in tile row order, for the band renderer."""
+    sql = """\
+        select rt.tx, rt.ty, bs.render, tc.color,
+            tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy
+        from regiontile as rt
+        inner join tilecomponent as tc
+            on tc.rtno = rt.rtno
+        inner join componentterrain as ct
+            on ct.tcno = tc.tcno
+        inner join terraintexture as tt
+            on tt.terrainid = ct.terrainid
+        inner join texturebitmap as tb
+            on tb.ttno = tt.ttno
+        inner join bitmapsprites as bs
+            on bs.texture = tb.texture
+            and bs.cx = tb.cx
+            and bs.cy = tb.cy
+        where rt.srno = %s
+        and ct.visible
+        {}
+        order by {}, bs.render, tc.tcno, ct.ctno
+        """
+    if stream:
+        tss = conn.cursor(name="sprites")
+        tss.itersize = 2000
+        order = "rt.ty, rt.tx"
+    else:
+        tss = conn.cursor()
+        order = "rt.tx, rt.ty"
+    with stats().stage("sprite query"):
+        if rtnos is None:
+            tss.execute(sql.format("", order), (srno,))
+        else:
+            tss.execute(sql.format("and rt.rtno = any(%s)", order),
+                (srno, rtnos))
+    return tss
+
+
+def tile_stacks(tss):
+    """Group sprite rows into (tx, ty, stack) with one stack per tile.
+    The time spent fetching rows counts as sprite query."""
+    seconds = stats().seconds
+    tile = None
+    stack = []
+    start = time.perf_counter()
+    for ts in tss:
+        if (ts["tx"], ts["ty"]) != tile:
+            if tile is not None:
+                seconds["sprite query"] += time.perf_counter() - start
+                yield tile[0], tile[1], tuple(stack)
+                start = time.perf_counter()
+            tile = (ts["tx"], ts["ty"])
+            stack = []
+        stack.append((ts["texture"], ts["cx"], ts["cy"], ts["sx"],
+            ts["sy"], ts["ox"], ts["oy"], ts["color"]))
+    seconds["sprite query"] += time.perf_counter() - start
+    if tile is not None:
+        yield tile[0], tile[1], tuple(stack)
+
+
+def coord_labels(xadj, yadj, tlx, tly):
+    """Yield (coordinate, axis, x, y) for every coordinate label of the
+    gutters: x labels along the top and bottom, y labels down the left
+    and right."""
+    x = 0
+    for low, high, _ in xadj:
+        for c in range(low, high + 1):
+            x += 1
+            yield c, "x", 110 * x + 90, 0
+            yield c, "x", 110 * x + 90, tly * 110 + 90 - 110
+        x += 1
+    y = 0
+    for low, high, _ in yadj:
+        for c in range(low, high + 1):
+            y += 1
+            yield c, "y", 0, 110 * y + 90
+            yield c, "y", tlx * 110 + 90 - 110, 110 * y + 90
+        y += 1
+
+
+def gutter_strips(xadj, yadj, tlx, tly):
+    """The labels of the gutters drawn on two strips, one 110 high for
+    the top and bottom and one 110 wide for the left and right. Returns
+    [(strip, positions)], the strip being pasted at each position."""
+    with stats().stage("coords"):
+        return draw_gutters(xadj, yadj, tlx, tly)
+
+
+def draw_gutters(xadj, yadj, tlx, tly):
+    sx = tlx * 110 + 90
+    sy = tly * 110 + 90
+    xstrip = Image.new(mode="RGBA", size=(sx, 110), color=(0, 0, 0, 0))
+    ystrip = Image.new(mode="RGBA", size=(110, sy), color=(0, 0, 0, 0))
+    for c, axis, x, y in coord_labels(xadj, yadj, tlx, tly):
+        # The first label of each pair is on the strip's own edge
+        if (axis == "x"
+        and y == 0):
+            xstrip.paste(coord_image(c, axis), (x, 0))
+        elif (axis == "y"
+        and x == 0):
+            ystrip.paste(coord_image(c, axis), (0, y))
+    return [(xstrip, [(0, 0), (0, sy - 110)]),
+        (ystrip, [(0, 0), (sx - 110, 0)])]
+
+
+def coord_image(c, axis):
+    """110x110 label of coordinate c, x labels sit low and y labels
+    sit right. Labels are drawn once and shared by every region and
+    thread, so they must not be changed."""
+    return bitmapfiles.once(coord_images, (c, axis),
+        lambda: draw_coord(c, axis))
+
+
+def draw_coord(c, axis):
+    newcoord = coord_template.copy()
+    draw = ImageDraw.Draw(newcoord)
+    _, _, w, h = draw.textbbox((0, 0), str(c), font=font50)
+    if axis == "x":
+        draw.text(((110 - w) / 2, (110 - h) - 5), str(c),
+            (0, 0, 0, 255), font=font50)
+    else:
+        draw.text((110 - w - 5, (110 - h) / 2), str(c),
+            (0, 0, 0, 255), font=font50)
+    return newcoord
+
+
+def render_map(conn, srno, xadj, yadj, tlx, tly):
+    """Render the whole map image of a region."""
+    stats().kind = "full"
+    # Create the empty map image
+    sx = tlx * 110 + 90
+    sy = tly * 110 + 90
+    new = Image.new(mode="RGBA", size=(sx, sy), color=(0, 0, 0, 0))
+
+    if COORDS:
+        for strip, positions in gutter_strips(xadj, yadj, tlx, tly):
+            for position in positions:
+                new.paste(strip, position, strip)
+
+    # Paste each tile once, with its sprites composed in render order
+    for tx, ty, stack in tile_stacks(sprite_rows(conn, srno)):
+        x, y = tile_position(tx, ty, xadj, yadj)
+        paste_stack(new, stack, x, y)
+    return new
+
+
+def repaint_tiles(conn, srno, new, generation, xadj, yadj):
+    """Repaint the tiles stamped after generation onto a rendered map.
+
+    A tile's 200x200 sprites reach into the tiles next to it, so each
+    changed tile is rendered with its eight neighbours on a patch and
+    only its own 200x200 square is copied back. Returns the number of
+    tiles repainted, or None when a full render is cheaper."""
+    sql = """\
+        select rtno, tx, ty, generation
+        from regiontile
+        where srno = %s
+        """
+    rtc = conn.cursor()
+    rtc.execute(sql, (srno,))
+    positions = {}  # (x, y) -> rtno
+    dirty = []
+    for row in rtc.fetchall():
+        x, y = tile_position(row["tx"], row["ty"], xadj, yadj)
+        positions[(x, y)] = row["rtno"]
+        if row["generation"] > generation:
+            dirty.append((x, y))
+    if len(dirty) > len(positions) * REPAINT_LIMIT:
+        return None
+
+    rtnos = set()
+    for x, y in dirty:
+        for dx, dy in NEIGHBOURS:
+            rtno = positions.get((x + dx, y + dy))
+            if rtno is not None:
+                rtnos.add(rtno)
+    stacks = {}
+    for tx, ty, stack in tile_stacks(sprite_rows(conn, srno, sorted(rtnos))):
+        stacks[tile_position(tx, ty, xadj, yadj)] = stack
+
+    for x, y in dirty:
+        patch = Image.new(mode="RGBA", size=(420, 420), color=(0, 0, 0, 0))
+        for dx, dy in NEIGHBOURS:
+            stack = stacks.get((x + dx, y + dy))
+            if stack:
+                paste_stack(patch, stack, dx + 110, dy + 110)
+        new.paste(patch.crop((110, 110, 310, 310)), (x, y))
+    stats().kind = "repaint"
+    return len(dirty)
+
+
+def write_png(conn, sr, xadj, yadj, tlx, tly):
+    """Write the map PNG of a region and its annotation overlay, updating
+    the last render when it can. Returns a status for the progress line."""
+    segment_name = sr["segmentname"]
+    region_name = sr["regionname"]
+    srno = sr["srno"]
+    rtc = conn.cursor()
+
+    mapfile = rf".\newmaps\{segment_name}\{region_name}{encoder.extension}"
+    # The format is part of the layout, the map of another format was
+    # rendered last and the file of this one is from an older run
+    layout = hashlib.sha256(repr((xadj, yadj, COORDS,
+        encoder.extension)).encode()).hexdigest()
+    sql = """\
+        select coalesce(max(generation), 0) as generation
+        from regiontile
+        where srno = %s
+        """
+    rtc.execute(sql, (srno,))
+    state = rtc.fetchone()
+    sql = """\
+        select generation, layout, annotations
+        from maprender
+        where srno = %s
+        """
+    rtc.execute(sql, (srno,))
+    rendered = rtc.fetchone()
+
+    # Repaint the changed tiles of the last render while the layout
+    # is the same, a new tile row or column moves every tile after it.
+    # New tiles that show anything are stamped like changed ones.
+    new = None
+    status = ""
+    reuse = (not FULL
+        and rendered
+        and rendered["layout"] == layout
+        and os.path.exists(mapfile))
+    if (reuse
+    and rendered["generation"] == state["generation"]):
+        status = " - unchanged"
+    elif BAND_ROWS:
+        # The band renderer never holds the whole map to repaint it
+        stream_png(conn, sr, xadj, yadj, tlx, tly)
+    elif reuse:
+        new = Image.open(mapfile).convert("RGBA")
+        repainted = repaint_tiles(conn, srno, new,
+            rendered["generation"], xadj, yadj)
+        if repainted is None:
+            new = None
+        else:
+            status = f" - {repainted} tiles repainted"
+
+    if status != " - unchanged":
+        prm = (srno, state["generation"], layout)
+        if (BAND_ROWS
+        or encoder.pool is None):
+            if not BAND_ROWS:
+                if new is None:
+                    new = render_map(conn, srno, xadj, yadj, tlx, tly)
+                with stats().stage("encode"):
+                    encoder.save(new, mapfile, srno)
+            record_render(rtc, prm)
+            conn.commit()
+        else:
+            if new is None:
+                new = render_map(conn, srno, xadj, yadj, tlx, tly)
+            # Recorded by record_saved once the encoder has written it, so
+            # maprender never describes a file that is not on disk
+            unrecorded[srno] = prm
+            with stats().stage("encode"):
+                encoder.save(new, mapfile, srno)
+
+    # The annotations are an overlay of their own, written again only
+    # when they change
+    annotations = annotation_rows(conn, srno, xadj, yadj)
+    digest = hashlib.sha256(repr([(x, y, ta["line1"], ta["line2"])
+        for x, y, ta in annotations]).encode()).hexdigest()
+    overlay = rf".\newmaps\{segment_name}\{region_name} Annotations.png"
+    if (not rendered
+    or rendered["annotations"] != digest
+    or os.path.exists(overlay) != bool(annotations)):
+        # Older runs drew the annotations onto a copy of the map, which
+        # would now be out of date
+        annotated = rf".\newmaps\{segment_name}\{region_name} Annotated.png"
+        if os.path.exists(annotated):
+            os.remove(annotated)
+        if annotations:
+            write_overlay(overlay, tlx * 110 + 90, tly * 110 + 90,
+                annotations)
+            status += " - annotations written"
+        elif os.path.exists(overlay):
+            os.remove(overlay)
+        sql = """\
+            update maprender
+            set annotations = %s
+            where srno = %s
+            """
+        rtc.execute(sql, (digest, srno))
+        conn.commit()
+
+    return status
+
+
+def record_render(cur, prm):
+    """Record what the map of a region was rendered from, prm being
+    (srno, generation, layout)."""
+    sql = """\
+        insert into maprender
+            (srno, generation, layout)
+        values (%s, %s, %s)
+        on conflict (srno) do update
+        set generation = excluded.generation,
+            layout = excluded.layout,
+            rendered = now()
+        """
+    cur.execute(sql, prm)
 
-def extract_sprite_threadsafe(texture, cx, cy, sx, sy, ox, oy, color):
-    """Thread-safe wrapper for bitmapfiles.extract_sprite."""
-    with bitmap_lock:
-        return bitmapfiles.extract_sprite(texture, cx, cy, sx, sy, ox, oy, color)
+
+def record_saved(conn):
+    """Record the renders of the maps the encoder saved since the last
+    call. Maps it failed to save keep the render of the file on disk."""
+    cur = conn.cursor()
+    for srno in encoder.take_saved():
+        prm = unrecorded.pop(srno, None)
+        if prm is not None:
+            record_render(cur, prm)
+    conn.commit()
+
+
+def annotation_rows(conn, srno, xadj, yadj):
+    """The annotations of a region as (x, y, row), x, y being where the
+    annotation goes on the map image."""
+    sql = """
+        select rt.tx, rt.ty, ta.line1, ta.line2
+        from regiontile rt
+        inner join tileannotate ta
+            on ta.rtno = rt.rtno
+        where rt.srno = %s
+        order by rt.tx, rt.ty
+        """
+    tas = conn.cursor()
+    tas.execute(sql, (srno,))
+    annotations = []
+    for ta in tas.fetchall():
+        x, y = tile_position(ta["tx"], ta["ty"], xadj, yadj)
+        annotations.append((x + 90, y + 90, ta))
+    return annotations
+
+
+def write_overlay(fn, sx, sy, annotations):
+    """Write the annotations of a map as a transparent PNG the size of
+    the map, to lay over it. The overlay is mostly empty, so it is drawn
+    and written OVERLAY_ROWS tile rows at a time."""
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    mapstats = stats()
+    band_height = OVERLAY_ROWS * 110
+    with pngstream.PNGWriter(fn, sx, sy, PNG_LEVEL) as png:
+        for top in range(0, sy, band_height):
+            bottom = min(top + band_height, sy)
+            with mapstats.stage("annotations"):
+                band = Image.new(mode="RGBA", size=(sx, bottom - top),
+                    color=(0, 0, 0, 0))
+                for x, y, ta in annotations:
+                    if (y < bottom
+                    and y + 110 > top):
+                        band.paste(annotation_image(ta), (x, y - top))
+            with mapstats.stage("encode"):
+                png.write_band(band)
+
+
+def annotation_image(ta):
+    """110x110 label of the one or two lines of an annotation. Labels
+    are drawn once and shared, so they must not be changed."""
+    return bitmapfiles.once(annotation_images, (ta["line1"], ta["line2"]),
+        lambda: draw_annotation(ta))
+
+
+def draw_annotation(ta):
+    newannotate = annotate_template.copy()
+    draw = ImageDraw.Draw(newannotate)
+    if ta["line1"]:
+        font = find_font_size(ta["line1"])
+        _, _, w, h = font.getbbox(ta["line1"])
+        if ta["line2"]:
+            draw.text(
+                ((110 - w) / 2, 5), str(ta["line1"]),
+                (0, 48, 128, 255), font=font)
+        else:
+            draw.text(
+                ((110 - w) / 2, (110 - h) / 2), str(ta["line1"]),
+                (0, 48, 128, 255), font=font)
+    if ta["line2"]:
+        font = find_font_size(ta["line2"])
+        _, _, w, h = font.getbbox(ta["line2"])
+        if ta["line1"]:
+            draw.text(
+                ((110 - w) / 2, 110 - h - 5), str(ta["line2"]),
+                (0, 48, 128, 255), font=font)
+        else:
+            draw.text(
+                ((110 - w) / 2, (110 - h) / 2), str(ta["line2"]),
+                (0, 48, 128, 255), font=font)
+    return newannotate
+
+
+def stream_png(conn, sr, xadj, yadj, tlx, tly):
+    """Render the map PNG of a region in bands of BAND_ROWS tile rows,
+    each written out before the next is drawn. Peak memory is one band
+    plus the tiles whose sprites reach into it."""
+    stats().kind = "full"
+    sx = tlx * 110 + 90
+    sy = tly * 110 + 90
+    base = rf".\newmaps\{sr['segmentname']}\{sr['regionname']}"
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    gutters = gutter_strips(xadj, yadj, tlx, tly) if COORDS else []
+    tiles = ((*tile_position(tx, ty, xadj, yadj), stack)
+        for tx, ty, stack in tile_stacks(
+            sprite_rows(conn, sr["srno"], stream=True)))
+    tile = next(tiles, None)
+    window = []
+    band_height = BAND_ROWS * 110
+
+    with pngstream.PNGWriter(base + ".png", sx, sy, PNG_LEVEL) as png:
+        for top in range(0, sy, band_height):
+            bottom = min(top + band_height, sy)
+            # Tiles come in tile row order, sprites reach 200px down
+            while (tile is not None
+            and tile[1] < bottom):
+                window.append(tile)
+                tile = next(tiles, None)
+            window = [t for t in window if t[1] + 200 > top]
+
+            band = Image.new(mode="RGBA", size=(sx, bottom - top),
+                color=(0, 0, 0, 0))
+            for strip, positions in gutters:
+                for x, y in positions:
+                    if (y < bottom
+                    and y + strip.size[1] > top):
+                        part = strip.crop((0, max(top - y, 0),
+                            strip.size[0], min(bottom - y, strip.size[1])))
+                        band.paste(part, (x, max(y - top, 0)), part)
+            # Paste in the tx, ty order of a full render
+            for x, y, stack in sorted(window, key=lambda t: t[:2]):
+                paste_stack(band, stack, x, y - top)
+            with stats().stage("encode"):
+                png.write_band(band)
+    conn.commit()  # ends the stream cursor
+
+
+def write_map_pyramid(conn, sr, xadj, yadj, tlx, tly):
+    """Write the map of a region as a DeepZoom tile pyramid."""
+    layers = []
+    if COORDS:
+        for c, axis, x, y in coord_labels(xadj, yadj, tlx, tly):
+            layers.append((x, y, 110, 110, ("coord", c, axis)))
+    for tx, ty, stack in tile_stacks(sprite_rows(conn, sr["srno"])):
+        x, y = tile_position(tx, ty, xadj, yadj)
+        layers.append((x, y, 200, 200, stack))
+
+    def paint(canvas, layer, ox, oy):
+        x, y, _, _, key = layer
+        if key[0] == "coord":
+            with stats().stage("coords"):
+                newcoord = coord_image(key[1], key[2])
+                canvas.paste(newcoord, (x - ox, y - oy), newcoord)
+        else:
+            paste_stack(canvas, key, x - ox, y - oy)
+
+    # Same size as the PNG, which crops nothing off
+    base = rf".\newmaps\{sr['segmentname']}\{sr['regionname']}"
+    if not os.path.exists(base + ".dzi"):
+        # A new pyramid draws every tile
+        stats().kind = "full"
+    written = mappyramid.write_pyramid(base, tlx * 110 + 90, tly * 110 + 90,
+        layers, paint, timer=lambda: stats().stage("encode"))
+    status = f" - {written} pyramid tiles written"
+
+    # The annotations are a pyramid of their own to lay over the map
+    layers = [(x, y, 110, 110, (ta["line1"], ta["line2"]))
+        for x, y, ta in annotation_rows(conn, sr["srno"], xadj, yadj)]
+
+    def paint_annotation(canvas, layer, ox, oy):
+        x, y, _, _, (line1, line2) = layer
+        with stats().stage("annotations"):
+            newannotate = annotation_image({"line1": line1, "line2": line2})
+            canvas.paste(newannotate, (x - ox, y - oy))
+
+    base += " Annotations"
+    if layers:
+        written = mappyramid.write_pyramid(base, tlx * 110 + 90,
+            tly * 110 + 90, layers, paint_annotation,
+            timer=lambda: stats().stage("encode"))
+        status += f", {written} annotation tiles"
+    elif os.path.exists(base + ".dzi"):
+        os.remove(base + ".dzi")
+        shutil.rmtree(base + "_files", ignore_errors=True)
+    return status
+
+
+def render_digest(conn, srno):
+    """Digest of everything the map of a region is drawn from: its tiles,
+    sprite rows and annotations, the texture files and the settings.
+    Returns (digest, annotated), annotated when the region has
+    annotations."""
+    rtc = conn.cursor()
+    digest = hashlib.sha256()
+    sql = """\
+        select md5(string_agg(tx || ',' || ty, ';'
+            order by tx, ty)) as tiles
+        from regiontile
+        where srno = %s
+        """
+    rtc.execute(sql, (srno,))
+    digest.update(repr(rtc.fetchone()["tiles"]).encode())
+    sql = """\
+        select md5(string_agg(concat_ws(',', rt.tx, rt.ty, bs.render,
+                tc.color, tb.texture, tb.cx, tb.cy, tb.sx, tb.sy,
+                tb.ox, tb.oy), ';'
+            order by rt.tx, rt.ty, bs.render, tc.tcno, ct.ctno)) as sprites,
+            array_agg(distinct tb.texture) as textures
+        from regiontile as rt
+        inner join tilecomponent as tc
+            on tc.rtno = rt.rtno
+        inner join componentterrain as ct
+            on ct.tcno = tc.tcno
+        inner join terraintexture as tt
+            on tt.terrainid = ct.terrainid
+        inner join texturebitmap as tb
+            on tb.ttno = tt.ttno
+        inner join bitmapsprites as bs
+            on bs.texture = tb.texture
+            and bs.cx = tb.cx
+            and bs.cy = tb.cy
+        where rt.srno = %s
+        and ct.visible
+        """
+    rtc.execute(sql, (srno,))
+    row = rtc.fetchone()
+    digest.update(repr(row["sprites"]).encode())
+    for texture in sorted(row["textures"] or ()):
+        try:
+            st = os.stat(rf".\unxnb\{texture}.png")
+            digest.update(repr((texture, st.st_mtime_ns, st.st_size)).encode())
+        except OSError:
+            digest.update(repr((texture, None)).encode())
+    sql = """\
+        select md5(string_agg(concat_ws(',', rt.tx, rt.ty,
+                ta.line1, ta.line2), ';'
+            order by rt.tx, rt.ty)) as annotations
+        from regiontile rt
+        inner join tileannotate ta
+            on ta.rtno = rt.rtno
+        where rt.srno = %s
+        """
+    rtc.execute(sql, (srno,))
+    annotations = rtc.fetchone()["annotations"]
+    digest.update(repr(annotations).encode())
+    conn.commit()
+    digest.update(repr((COORDS, OUTPUT, encoder.extension, PNG_LEVEL)).encode())
+    return digest.hexdigest(), annotations is not None
+
+
+def outputs_exist(sr, annotated):
+    """Whether the files of the last render of a region are all there,
+    with its annotation overlay when it has annotations."""
+    base = rf".\newmaps\{sr['segmentname']}\{sr['regionname']}"
+    files = []
+    if OUTPUT != "pyramid":
+        files.append(base + encoder.extension)
+        if annotated:
+            files.append(base + " Annotations.png")
+    if OUTPUT != "png":
+        files.append(base + ".dzi")
+        if annotated:
+            files.append(base + " Annotations.dzi")
+    return all(os.path.exists(fn) for fn in files)
+
+
+def is_current(sr, digest, annotated):
+    """Whether the last render of a region is still what it would draw."""
+    return (not FULL
+        and digest == sr.get("digest")
+        and outputs_exist(sr, annotated))
 
 
 def generate_map(sr_data):
-    """Generate a single map. Called from thread pool."""
+    """Generate a single map. Called from thread pool. Returns the
+    progress line, the digest of what the map was drawn from, the
+    seconds it took, both None when it was not drawn, and the report
+    row of its MapStats."""
+    mapstats = current.stats = mapreport.MapStats()
     # Each thread gets its own database connection
+    start = time.perf_counter()
     conn = get_connection()
 
     try:
@@ -56,7 +724,15 @@ def generate_map(sr_data):
         region_name = sr["regionname"]
         srno = sr["srno"]
 
+        # Skip the region when nothing it is drawn from changed
+        with mapstats.stage("digest"):
+            digest, annotated = render_digest(conn, srno)
+        if is_current(sr, digest, annotated):
+            return (f"{segment_name} {region_name} - skipped, unchanged",
+                digest, None, mapstats.row())
+
         # Get X coordinates
+        layout_start = time.perf_counter()
         sql = """\
             select distinct tx
             from regiontile
@@ -68,7 +744,8 @@ def generate_map(sr_data):
         rows = rtc.fetchall()
 
         if not rows:
-            return f"{segment_name} {region_name} - No tile data"
+            return (f"{segment_name} {region_name} - No tile data",
+                None, None, mapstats.row())
 
         xadj = []
         low = None
@@ -121,175 +798,45 @@ def generate_map(sr_data):
         if COORDS:
             tlx += 1
             tly += 1
+        mapstats.seconds["layout"] += time.perf_counter() - layout_start
 
-        # Create the empty map image
-        sx = tlx * 110 + 90
-        sy = tly * 110 + 90
-        new = Image.new(mode="RGBA", size=(sx, sy), color=(0, 0, 0, 0))
+        status = ""
+        if OUTPUT != "pyramid":
+            status += write_png(conn, sr, xadj, yadj, tlx, tly)
+        if OUTPUT != "png":
+            status += write_map_pyramid(conn, sr, xadj, yadj, tlx, tly)
 
-        if COORDS:
-            # Create top X coordinates
-            x = 0
-            for low, high, _ in xadj:
-                for c in range(low, high + 1):
-                    x += 1
-                    newcoord = coord_template.copy()
-                    draw = ImageDraw.Draw(newcoord)
-                    _, _, w, h = draw.textbbox((0, 0), str(c), font=font50)
-                    draw.text(((110 - w) / 2, (110 - h) - 5), str(c),
-                        (0, 0, 0, 255), font=font50)
-                    box = (110 * x + 90, 0, 110 * x + 90 + 110, 110)
-                    new.paste(newcoord, box, newcoord)
-                x += 1
-
-            # Copy X coordinates to bottom
-            box = (0, 0, tlx * 110 + 90, 110)
-            crop = new.crop(box)
-            box = (0, tly * 110 + 90 - 110, tlx * 110 + 90, tly * 110 + 90)
-            new.paste(crop, box, crop)
-
-            # Create left Y coordinates
-            y = 0
-            for low, high, _ in yadj:
-                for c in range(low, high + 1):
-                    y += 1
-                    newcoord = coord_template.copy()
-                    draw = ImageDraw.Draw(newcoord)
-                    _, _, w, h = draw.textbbox((0, 0), str(c), font=font50)
-                    draw.text((110 - w - 5, (110 - h) / 2), str(c),
-                        (0, 0, 0, 255), font=font50)
-                    box = (0, 110 * y + 90, 110, 110 * y + 90 + 110)
-                    new.paste(newcoord, box, newcoord)
-                y += 1
-
-            # Copy Y coordinates to right
-            box = (0, 0, 110, tly * 110 + 90)
-            crop = new.crop(box)
-            box = (tlx * 110 + 90 - 110, 0, tlx * 110 + 90, tly * 110 + 90)
-            new.paste(crop, box, crop)
-
-        # Get tile sprites
-        sql = """\
-            select rt.tx, rt.ty, bs.render, tc.color,
-                tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy
-            from regiontile as rt
-            inner join tilecomponent as tc
-                on tc.rtno = rt.rtno
-            inner join componentterrain as ct
-                on ct.tcno = tc.tcno
-            inner join terraintexture as tt
-                on tt.terrainid = ct.terrainid
-            inner join texturebitmap as tb
-                on tb.ttno = tt.ttno
-            inner join bitmapsprites as bs
-                on bs.texture = tb.texture
-                and bs.cx = tb.cx
-                and bs.cy = tb.cy
-            where rt.srno = %s
-            and (mod(ct.base, 2) <> 0
-            or mod(ct.wall, 2) <> 0
-            or mod(ct.door, 2) <> 0)
-            order by rt.tx, rt.ty, bs.render
-            """
-        tss = conn.cursor()
-        tss.execute(sql, (srno,))
-
-        while True:
-            ts = tss.fetchone()
-            if ts is None:
-                break
-            xindex = 0
-            while ts["tx"] > xadj[xindex][1]:
-                xindex += 1
-            yindex = 0
-            while ts["ty"] > yadj[yindex][1]:
-                yindex += 1
-            x = (ts["tx"] + xadj[xindex][2]) * 110
-            y = (ts["ty"] + yadj[yindex][2]) * 110
-
-            # Use thread-safe sprite extraction
-            sprite = extract_sprite_threadsafe(
-                ts["texture"], ts["cx"], ts["cy"], ts["sx"], ts["sy"],
-                ts["ox"], ts["oy"], ts["color"]
-            )
-            box = (x, y, x + sprite.size[0], y + sprite.size[1])
-            new.paste(sprite, box, sprite)
-
-        mapfile = rf".\newmaps\{segment_name}\{region_name}.png"
-        os.makedirs(os.path.dirname(mapfile), exist_ok=True)
-        new.save(mapfile)
-
-        # Annotated map
-        sql = """
-            select rt.tx, rt.ty, ta.line1, ta.line2
-            from regiontile rt
-            inner join tileannotate ta
-                on ta.rtno = rt.rtno
-            where rt.srno = %s
-            order by rt.tx, rt.ty
-            """
-        tas = conn.cursor()
-        tas.execute(sql, (srno,))
-
-        if tas.rowcount:
-            while True:
-                ta = tas.fetchone()
-                if ta is None:
-                    break
-                xindex = 0
-                while ta["tx"] > xadj[xindex][1]:
-                    xindex += 1
-                yindex = 0
-                while ta["ty"] > yadj[yindex][1]:
-                    yindex += 1
-                x = (ta["tx"] + xadj[xindex][2]) * 110 + 90
-                y = (ta["ty"] + yadj[yindex][2]) * 110 + 90
-
-                newannotate = annotate_template.copy()
-                draw = ImageDraw.Draw(newannotate)
-                if ta["line1"]:
-                    font = find_font_size(ta["line1"])
-                    _, _, w, h = font.getbbox(ta["line1"])
-                    if ta["line2"]:
-                        draw.text(
-                            ((110 - w) / 2, 5), str(ta["line1"]),
-                            (0, 48, 128, 255), font=font)
-                    else:
-                        draw.text(
-                            ((110 - w) / 2, (110 - h) / 2), str(ta["line1"]),
-                            (0, 48, 128, 255), font=font)
-                if ta["line2"]:
-                    font = find_font_size(ta["line2"])
-                    _, _, w, h = font.getbbox(ta["line2"])
-                    if ta["line1"]:
-                        draw.text(
-                            ((110 - w) / 2, 110 - h - 5), str(ta["line2"]),
-                            (0, 48, 128, 255), font=font)
-                    else:
-                        draw.text(
-                            ((110 - w) / 2, (110 - h) / 2), str(ta["line2"]),
-                            (0, 48, 128, 255), font=font)
-
-                box = (x, y, x + newannotate.size[0], y + newannotate.size[1])
-                new.paste(newannotate, box, newannotate)
-
-            mapfile = rf".\newmaps\{segment_name}\{region_name} Annotated.png"
-            os.makedirs(os.path.dirname(mapfile), exist_ok=True)
-            new.save(mapfile)
-
-        return f"{segment_name} {region_name}"
+        return (f"{segment_name} {region_name}{status}", digest,
+            time.perf_counter() - start, mapstats.row())
 
     except Exception as e:
-        return f"{sr_data['segmentname']} {sr_data['regionname']} - ERROR: {e}"
+        return (f"{sr_data['segmentname']} {sr_data['regionname']}"
+            f" - ERROR: {e}", None, None, mapstats.row())
 
     finally:
         conn.close()
 
 
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST), exist_ok=True)
+    with open(MANIFEST + ".partial", "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(MANIFEST + ".partial", MANIFEST)
+
+
+def load_font(size):
+    return bitmapfiles.once(fonts, size, lambda: ImageFont.truetype(FONT, size))
+
+
 def find_font_size(text):
+    """The largest font, up to 50, that fits text in 100 pixels."""
+    return bitmapfiles.once(fitted_fonts, text, lambda: fit_font(text))
+
+
+def fit_font(text):
     size = 50
     while size > 0:
-        font = ImageFont.truetype(r"font\CommitMono-400-Regular.otf", size)
+        font = load_font(size)
         _, _, w, h = font.getbbox(text)
         if w <= 100:
             break
@@ -302,12 +849,76 @@ def main():
     parser.add_argument('--segment', type=int, help='Filter by segment ID')
     parser.add_argument('--region', type=int, help='Filter by region ID')
     parser.add_argument('--threads', type=int, default=4, help='Number of worker threads (default: 4)')
+    parser.add_argument('--processes', type=int, default=0,
+        help='Render in this many processes instead of threads, sharing '
+            'the decoded sprites between them (default: 0, use threads)')
+    parser.add_argument('--shared-sprites', type=int, default=4096,
+        help='Most sprites made once and shared by the --processes, '
+            '160KB of shared memory each (default: 4096)')
+    parser.add_argument('--full', action='store_true',
+        help='Render every map from scratch instead of repainting the '
+            'tiles changed since the last render')
+    parser.add_argument('--output', choices=('png', 'pyramid', 'both'),
+        default='png',
+        help='Write a PNG per map, a DeepZoom tile pyramid per map for '
+            'viewing in a browser, or both (default: png)')
+    parser.add_argument('--format', choices=('png', 'webp', 'draft'),
+        default='png',
+        help='Save maps as PNG, lossless WebP, which is smaller but slower, '
+            'or draft, PNG compressed as little as possible for quick '
+            'looks (default: png)')
+    parser.add_argument('--png-level', type=int, choices=range(10),
+        default=6, metavar='0-9',
+        help='PNG compression level, higher is smaller and slower '
+            '(default: 6)')
+    parser.add_argument('--encoders', type=int, default=2,
+        help='Threads saving map images while the next maps are drawn '
+            '(default: 2)')
+    parser.add_argument('--encode-queue', type=int, default=2,
+        help='Map images waiting to be saved before drawing waits for '
+            'them, each holds a whole map in memory (default: 2)')
+    parser.add_argument('--report', default=r'.\newmaps\report',
+        help='Write the time each map spent in each stage, and the cache '
+            'hit rates, to this file as .json and .csv '
+            '(default: newmaps\\report)')
+    parser.add_argument('--tile-cache', type=int,
+        help='Composed tiles each thread pool or process keeps, about 200KB '
+            'each (default: 2000, 200 with --band-rows)')
+    parser.add_argument('--sprite-cache', type=int,
+        help='Finished sprites each thread pool or process keeps, about '
+            '160KB each (default: 2000, 200 with --band-rows)')
+    parser.add_argument('--band-rows', type=int, default=0,
+        help='Render PNGs a band of this many tile rows at a time and '
+            'stream them to disk, for maps too big for memory '
+            '(default: 0, render whole maps)')
     args = parser.parse_args()
+    if (args.band_rows
+    and args.format == 'webp'):
+        parser.error('--band-rows streams PNG, it cannot write webp')
+
+    global FULL, OUTPUT, BAND_ROWS, PNG_LEVEL, TILE_CACHE_LIMIT, encoder
+    FULL = args.full
+    OUTPUT = args.output
+    BAND_ROWS = args.band_rows
+    if args.tile_cache is not None:
+        TILE_CACHE_LIMIT = args.tile_cache
+    elif BAND_ROWS:
+        TILE_CACHE_LIMIT = BAND_TILE_CACHE
+    if args.sprite_cache is not None:
+        bitmapfiles.SPRITE_LIMIT = args.sprite_cache
+    elif BAND_ROWS:
+        bitmapfiles.SPRITE_LIMIT = BAND_SPRITE_CACHE
+    PNG_LEVEL = args.png_level
+    image_format = args.format
+    if image_format == 'draft':
+        PNG_LEVEL = DRAFT_LEVEL
+        image_format = 'png'
 
     # Initialize shared resources before spawning threads
     init_shared_resources()
 
     conn = get_connection()
+    migrate(conn)
 
     # Build the WHERE clause based on command line arguments
     where_clauses = []
@@ -347,6 +958,16 @@ def main():
 
     # Fetch all regions to process
     regions = srs.fetchall()
+
+    # Draw the regions predicted to take longest first, so a big region
+    # does not start last and keep the run going after the rest are done
+    sizes = mapschedule.region_sizes(conn, [sr["srno"] for sr in regions])
+    history = mapschedule.RenderHistory()
+    for sr in regions:
+        sr["tiles"], sr["terrains"] = sizes.get(sr["srno"], (0, 0))
+        sr["predicted"] = history.predict(sr["srno"], sr["tiles"],
+            sr["terrains"])
+    regions.sort(key=lambda sr: sr["predicted"], reverse=True)
     conn.close()
 
     if not regions:
@@ -354,21 +975,109 @@ def main():
         return
 
     total = len(regions)
-    print(f"Generating {total} maps using {args.threads} threads...")
+    try:
+        with open(MANIFEST, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+    for sr in regions:
+        sr["digest"] = manifest.get(str(sr["srno"]))
+    sprite_store = None
+    if args.processes:
+        # Make the most used sprites of the maps to draw once for all the
+        # processes, which make any others themselves. The parent encoder
+        # only names the files to look for.
+        encoder = mapencoder.Encoder(image_format, PNG_LEVEL, workers=0)
+        conn = get_connection()
+        drawn = [sr["srno"] for sr in regions
+            if not is_current(sr, *render_digest(conn, sr["srno"]))]
+        sprite_store = spritestore.SpriteStore.create(
+            spritestore.sprite_keys(conn, drawn, args.shared_sprites))
+        conn.close()
+        print(f"Generating {total} maps using {args.processes} processes, "
+            f"{len(sprite_store.index)} sprites shared...")
+        executor = ProcessPoolExecutor(max_workers=args.processes,
+            initializer=init_process,
+            initargs=((COORDS, FULL, OUTPUT, BAND_ROWS, PNG_LEVEL,
+                TILE_CACHE_LIMIT, bitmapfiles.SPRITE_LIMIT, image_format),
+                sprite_store.name, sprite_store.index))
+    else:
+        print(f"Generating {total} maps using {args.threads} threads...")
+        executor = ThreadPoolExecutor(max_workers=args.threads)
+        encoder = mapencoder.Encoder(image_format, PNG_LEVEL,
+            args.encoders, args.encode_queue)
 
-    # Use ThreadPoolExecutor to process maps in parallel
+    # Process maps in parallel
     completed = 0
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        # Submit all tasks
-        future_to_region = {executor.submit(generate_map, sr): sr for sr in regions}
+    predicted = 0.0
+    took = 0.0
+    rows = []
+    full = []  # (sr, seconds) of the maps drawn in full
+    conn = get_connection()
+    try:
+        with executor:
+            # Submit all tasks
+            future_to_region = {executor.submit(generate_map, sr): sr for sr in regions}
+
+            # Process completed tasks as they finish
+            for future in as_completed(future_to_region):
+                completed += 1
+                result, digest, seconds, row = future.result()
+                sr = future_to_region[future]
+                rows.append(dict(segment=sr["segmentname"],
+                    region=sr["regionname"], srno=sr["srno"],
+                    status=result, drawn=seconds is not None,
+                    predicted=round(sr["predicted"], 4),
+                    tiles=sr["tiles"], terrains=sr["terrains"], **row))
+                if seconds is not None:
+                    result += (f" ({seconds:.1f}s,"
+                        f" predicted {sr['predicted']:.1f}s)")
+                    predicted += sr["predicted"]
+                    took += seconds
+                    if row["kind"] == "full":
+                        full.append((sr, seconds))
+                print(f"[{completed}/{total}] {result}")
+                srno = str(sr["srno"])
+                if digest is None:
+                    manifest.pop(srno, None)
+                else:
+                    manifest[srno] = digest
+                if encoder:
+                    record_saved(conn)
+    finally:
+        if sprite_store:
+            sprite_store.unlink()
+        if encoder:
+            encoder.close()
+            record_saved(conn)
+            for srno, fn, error in encoder.failed:
+                # Render those maps again next time
+                print(f"Could not save {fn}: {error}")
+                manifest.pop(str(srno), None)
+        conn.close()
+        # Keep the digests of the maps drawn, even when the run stops early
+        save_manifest(manifest)
+
+    # Images saved on the encoder's own threads took this long besides
+    background = {}
+    if (encoder is not None
+    and encoder.pool is not None):
+        background = encoder.timings
+    for row in rows:
+        row["background encode"] = round(background.get(row["srno"], 0.0), 4)
 
-        # Process completed tasks as they finish
-        for future in as_completed(future_to_region):
-            completed += 1
-            result = future.result()
-            print(f"[{completed}/{total}] {result}")
+    # Repaints and unchanged maps take a fraction of a full render and
+    # would have big regions predicted to be quick
+    for sr, seconds in full:
+        history.record(sr["srno"], sr["tiles"], sr["terrains"],
+            seconds + background.get(sr["srno"], 0.0))
+    history.save()
+    settings = dict(vars(args), format=image_format, png_level=PNG_LEVEL)
+    mapreport.write_report(args.report, rows, settings)
 
     print(f"\nCompleted generating {total} maps.")
+    if took:
+        print(f"Drawing took {took:.1f}s, predicted {predicted:.1f}s.")
 
 
 if __name__ == "__main__":
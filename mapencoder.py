@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+# format -> (file extension, PIL format, save options)
+FORMATS = {
+    "png": (".png", "PNG", {}),
+    # exact keeps the colour of clear pixels, which repaints rely on
+    "webp": (".webp", "WEBP", {"lossless": True, "exact": True}),
+}
+
+
+class Encoder:
+    """Saves map images on a pool of its own, so the next map can be
+    composed while the last one is encoded.
+
+    save() hands an image over and returns at once unless queue images
+    are already waiting, which bounds the memory held by the queue. An
+    image must not be changed after it is handed over. Files are written
+    under a temporary name and renamed, so a failed save leaves the last
+    file in place; failures are kept in failed as (key, fn, error), the
+    keys of the images saved until take_saved() collects them, and the
+    seconds each image took to save in timings by key. With workers=0
+    images are saved before save() returns."""
+
+    def __init__(self, format="png", level=6, workers=2, queue=2):
+        self.extension, self.format, options = FORMATS[format]
+        self.options = dict(options)
+        if format == "png":
+            self.options["compress_level"] = level
+        self.pool = None
+        if workers:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+            self.slots = threading.BoundedSemaphore(workers + queue)
+        self.failed = []
+        self.saved = []
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def write(self, image, fn, key=None):
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        partial = fn + ".partial"
+        image.save(partial, self.format, **self.options)
+        os.replace(partial, fn)
+        with self.lock:
+            self.timings[key] = time.perf_counter() - start
+            self.saved.append(key)
+
+    def save(self, image, fn, key=None):
+        if self.pool is None:
+            self.write(image, fn, key)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self.write, image, fn, key)
+        future.add_done_callback(lambda f: self.done(f, fn, key))
+
+    def done(self, future, fn, key):
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            with self.lock:
+                self.failed.append((key, fn, error))
+
+    def take_saved(self):
+        """The keys of the images saved since the last call."""
+        with self.lock:
+            saved = self.saved
+            self.saved = []
+        return saved
+
+    def close(self):
+        """Wait for the images handed over to be saved."""
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,135 @@
+import contextlib
+import hashlib
+import json
+import math
+import os
+import shutil
+
+from PIL import Image
+
+TILE_SIZE = 512
+MANIFEST = "manifest.json"
+
+
+def dzi(width, height, tile_size=TILE_SIZE):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"'
+        f' Format="png" Overlap="0" TileSize="{tile_size}">\n'
+        f'  <Size Width="{width}" Height="{height}"/>\n'
+        '</Image>\n')
+
+
+def write_pyramid(base, width, height, layers, paint, tile_size=TILE_SIZE,
+        timer=None):
+    """Write a width x height image as a DeepZoom pyramid, base.dzi and
+    base_files/<level>/<col>_<row>.png, without ever holding more than
+    one full resolution tile or four smaller ones.
+
+    layers are (x, y, w, h, key) boxes in paint order. paint(canvas,
+    layer, ox, oy) draws a layer onto a tile whose top left is at ox, oy
+    of the image. key identifies what a layer draws: a tile is only
+    written again when the keys and positions of the layers over it
+    change, and a lower level tile when one of the four above it does.
+    timer, when given, is called for a context manager each tile is saved
+    in, to time the encoding. Returns the number of tiles written."""
+    files = base + "_files"
+    os.makedirs(files, exist_ok=True)
+    manifest_fn = os.path.join(files, MANIFEST)
+    try:
+        with open(manifest_fn, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get("size") != [width, height, tile_size]:
+        # Every tile moves, start over without the tiles of the old size
+        shutil.rmtree(files)
+        os.makedirs(files)
+        manifest = {}
+    digests = manifest.get("tiles", {})
+    written = 0
+
+    # Layers over each full resolution tile, in paint order
+    top = math.ceil(math.log2(max(width, height, 1)))
+    cols = math.ceil(width / tile_size)
+    rows = math.ceil(height / tile_size)
+    over = {}
+    for layer in layers:
+        x, y, w, h, _ = layer
+        for col in range(max(x // tile_size, 0),
+                min((x + w - 1) // tile_size, cols - 1) + 1):
+            for row in range(max(y // tile_size, 0),
+                    min((y + h - 1) // tile_size, rows - 1) + 1):
+                over.setdefault((col, row), []).append(layer)
+
+    def save(level, col, row, digest, render):
+        nonlocal written
+        name = f"{level}/{col}_{row}"
+        fn = os.path.join(files, str(level), f"{col}_{row}.png")
+        if (digests.get(name) != digest
+        or not os.path.exists(fn)):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            image = render()
+            with timer() if timer else contextlib.nullcontext():
+                image.save(fn)
+            written += 1
+        digests[name] = digest
+        return digest
+
+    level_digests = {}
+    for col in range(cols):
+        for row in range(rows):
+            def render(col=col, row=row):
+                ox = col * tile_size
+                oy = row * tile_size
+                tile = Image.new(mode="RGBA",
+                    size=(min(tile_size, width - ox), min(tile_size, height - oy)),
+                    color=(0, 0, 0, 0))
+                for layer in over.get((col, row), ()):
+                    paint(tile, layer, ox, oy)
+                return tile
+            key = repr([(x, y, key) for x, y, _, _, key in over.get((col, row), ())])
+            digest = hashlib.sha256(key.encode()).hexdigest()
+            level_digests[(col, row)] = save(top, col, row, digest, render)
+
+    # Each lower level halves the one above it
+    level_width = width
+    level_height = height
+    for level in range(top - 1, -1, -1):
+        upper = level_digests
+        level_digests = {}
+        upper_width = level_width
+        upper_height = level_height
+        level_width = math.ceil(level_width / 2)
+        level_height = math.ceil(level_height / 2)
+        for col in range(math.ceil(level_width / tile_size)):
+            for row in range(math.ceil(level_height / tile_size)):
+                children = [(col * 2 + dx, row * 2 + dy)
+                    for dx in (0, 1) for dy in (0, 1)
+                    if (col * 2 + dx, row * 2 + dy) in upper]
+
+                def render(level=level, col=col, row=row, children=children):
+                    ox = col * tile_size * 2
+                    oy = row * tile_size * 2
+                    sx = min(tile_size * 2, upper_width - ox)
+                    sy = min(tile_size * 2, upper_height - oy)
+                    joined = Image.new(mode="RGBA", size=(sx, sy),
+                        color=(0, 0, 0, 0))
+                    for ccol, crow in children:
+                        fn = os.path.join(files, str(level + 1),
+                            f"{ccol}_{crow}.png")
+                        with Image.open(fn) as child:
+                            joined.paste(child, ((ccol - col * 2) * tile_size,
+                                (crow - row * 2) * tile_size))
+                    return joined.resize((math.ceil(sx / 2), math.ceil(sy / 2)),
+                        resample=Image.LANCZOS)
+                key = repr([upper[child] for child in children])
+                digest = hashlib.sha256(key.encode()).hexdigest()
+                level_digests[(col, row)] = save(level, col, row, digest, render)
+
+    with open(base + ".dzi", "w") as file:
+        file.write(dzi(width, height, tile_size))
+    manifest = {"size": [width, height, tile_size], "tiles": digests}
+    with open(manifest_fn, "w") as file:
+        json.dump(manifest, file)
+    return written
@@ -0,0 +1,89 @@
+from collections import Counter
+from contextlib import contextmanager
+import csv
+import json
+import os
+import time
+
+# Stages of drawing a map, timed on the thread drawing it
+STAGES = ["digest", "layout", "sprite query", "sprites", "compose", "paste",
+    "coords", "annotations", "encode"]
+# Caches whose hits and misses are counted while drawing
+CACHES = ["sprite", "tile"]
+
+
+class MapStats:
+    """Seconds spent in each stage of drawing one map and the cache
+    lookups it made. Stages must not nest, or time is counted twice.
+    Time in no stage is reported as other. kind is "full" when every
+    tile was drawn, "repaint" when only changed tiles were, else None."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.kind = None
+        self.seconds = Counter()
+        self.caches = {cache: Counter() for cache in CACHES}  # hits, misses
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def row(self):
+        seconds = time.perf_counter() - self.start
+        row = {"kind": self.kind, "seconds": round(seconds, 4)}
+        for stage in STAGES:
+            row[stage] = round(self.seconds[stage], 4)
+        row["other"] = round(seconds - sum(self.seconds.values()), 4)
+        for cache in CACHES:
+            row[f"{cache} hits"] = self.caches[cache]["hits"]
+            row[f"{cache} misses"] = self.caches[cache]["misses"]
+        return row
+
+
+def totals(rows):
+    """Sums of the numeric columns of the report rows, with the hit rate
+    of each cache."""
+    total = Counter()
+    for row in rows:
+        for key, value in row.items():
+            if (isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and key != "srno"):
+                total[key] += value
+    total = {key: round(value, 4) for key, value in total.items()}
+    for cache in CACHES:
+        hits = total.get(f"{cache} hits", 0)
+        lookups = hits + total.get(f"{cache} misses", 0)
+        total[f"{cache} hit rate"] = (round(hits / lookups, 4)
+            if lookups else None)
+    return total
+
+
+def write_report(base, rows, settings):
+    """Write the rows of a run as base.json, with totals and settings, and
+    as base.csv, one line per region and a total line."""
+    total = totals(rows)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    report = {
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "settings": settings,
+        "totals": total,
+        "regions": rows,
+    }
+    with open(base + ".json", "w") as file:
+        json.dump(report, file, indent=1)
+
+    columns = []
+    for row in rows + [total]:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    with open(base + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+        writer.writerow(dict(total, region="total"))
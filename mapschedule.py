@@ -0,0 +1,89 @@
+import json
+import os
+
+HISTORY = r".\newmaps\history.json"
+# Seconds per tile and per visible terrain before there is any history
+TILE_RATE = 0.002
+TERRAIN_RATE = 0.001
+
+
+def region_sizes(conn, srnos):
+    """{srno: (tiles, terrains)} of the regions srnos, terrains being the
+    visible terrains a map pastes sprites for."""
+    sql = """\
+        select rt.srno, count(distinct rt.rtno) as tiles,
+            count(ct.ctno) as terrains
+        from regiontile rt
+        left join tilecomponent tc
+            on tc.rtno = rt.rtno
+        left join componentterrain ct
+            on ct.tcno = tc.tcno
+            and ct.visible
+        where rt.srno = any(%s)
+        group by rt.srno
+        """
+    cur = conn.cursor()
+    cur.execute(sql, (list(srnos),))
+    sizes = {row["srno"]: (row["tiles"], row["terrains"])
+        for row in cur.fetchall()}
+    conn.commit()
+    return sizes
+
+
+class RenderHistory:
+    """How long regions took to draw in full, and save, on earlier runs,
+    kept in HISTORY. Repaints are not recorded.
+
+    A region drawn before is predicted from its own last time, scaled by
+    how much it has grown. Other regions are predicted from seconds per
+    tile and per terrain, fitted to every region in the history."""
+
+    def __init__(self, fn=HISTORY):
+        self.fn = fn
+        try:
+            with open(fn, "r") as file:
+                self.regions = json.load(file)
+        except (OSError, ValueError):
+            self.regions = {}  # srno -> {seconds, tiles, terrains}
+        self.rates = self.fit()
+
+    def fit(self):
+        """Least squares seconds per tile and per terrain, without an
+        intercept, or the defaults when the history cannot tell."""
+        stt = stv = svv = sts = svs = 0.0
+        for past in self.regions.values():
+            t, v, s = past["tiles"], past["terrains"], past["seconds"]
+            stt += t * t
+            stv += t * v
+            svv += v * v
+            sts += t * s
+            svs += v * s
+        det = stt * svv - stv * stv
+        if det > 0:
+            tile_rate = (sts * svv - svs * stv) / det
+            terrain_rate = (svs * stt - sts * stv) / det
+            if (tile_rate >= 0
+            and terrain_rate >= 0):
+                return tile_rate, terrain_rate
+        if svv > 0:
+            # Tiles and terrains grow together, terrains alone will do
+            return 0.0, svs / svv
+        return TILE_RATE, TERRAIN_RATE
+
+    def predict(self, srno, tiles, terrains):
+        """Predicted seconds to draw a region."""
+        past = self.regions.get(str(srno))
+        if past:
+            return past["seconds"] * (terrains + 1) / (past["terrains"] + 1)
+        tile_rate, terrain_rate = self.rates
+        return tile_rate * tiles + terrain_rate * terrains
+
+    def record(self, srno, tiles, terrains, seconds):
+        self.regions[str(srno)] = {"seconds": round(seconds, 3),
+            "tiles": tiles, "terrains": terrains}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with open(self.fn + ".partial", "w") as file:
+            json.dump(self.regions, file, indent=1, sort_keys=True)
+        os.replace(self.fn + ".partial", self.fn)
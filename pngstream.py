@@ -0,0 +1,121 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IDAT_SIZE = 1 << 20  # compressed bytes gathered before an IDAT chunk
+FILTER_ROWS = 64  # rows filtered at a time, bounding the filter arrays
+
+
+def filter_rows(rows, prior):
+    """PNG filter the rows, a (height, width * 4) uint8 array of RGBA,
+    prior being the row above the first. Each row gets the filter whose
+    bytes sum least as signed values, as libpng chooses. Returns the
+    filtered rows, each led by its filter type byte."""
+    x = rows.astype(np.int16)
+    b = np.vstack((prior[np.newaxis], rows[:-1])).astype(np.int16)
+    a = np.zeros_like(x)
+    a[:, 4:] = x[:, :-4]
+    c = np.zeros_like(x)
+    c[:, 4:] = b[:, :-4]
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    # None, Sub, Up, Average and Paeth
+    filtered = np.stack((x, x - a, x - b, x - (a + b) // 2, x - paeth)) \
+        .astype(np.uint8)
+    cost = filtered.view(np.int8).astype(np.int16)
+    best = np.abs(cost).sum(axis=2, dtype=np.int64).argmin(axis=0)
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = best
+    out[:, 1:] = filtered[best, np.arange(rows.shape[0])]
+    return out
+
+
+class PNGWriter:
+    """Write an 8 bit RGBA PNG a band of rows at a time, so the whole
+    image never has to be in memory. Each row is filtered, as PIL and
+    libpng do, with the filter that suits it best. The PNG
+    is written under a temporary name and only replaces fn once it is
+    complete, so an error leaves the last file in place.
+
+    with PNGWriter(fn, width, height) as png:
+        png.write_band(image)  # full width, any height, top to bottom"""
+
+    def __init__(self, fn, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.prior = np.zeros(width * 4, dtype=np.uint8)  # row above
+        self.fn = fn
+        self.partial = fn + ".partial"
+        self.file = open(self.partial, "wb")
+        self.compress = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(SIGNATURE)
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_band(self, image):
+        """Append the rows of an RGBA image as wide as the PNG."""
+        if image.size[0] != self.width:
+            raise ValueError(f"Band is {image.size[0]} wide, not {self.width}")
+        if self.rows + image.size[1] > self.height:
+            raise ValueError("Band runs past the bottom of the image")
+        rows = np.frombuffer(image.tobytes(), dtype=np.uint8) \
+            .reshape(image.size[1], self.width * 4)
+        for top in range(0, len(rows), FILTER_ROWS):
+            part = rows[top:top + FILTER_ROWS]
+            self.add(self.compress.compress(
+                filter_rows(part, self.prior).tobytes()))
+            self.prior = part[-1]
+        self.rows += image.size[1]
+
+    def add(self, data):
+        if not data:
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self.chunk(b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.rows != self.height:
+            self.abort()
+            raise ValueError(f"Wrote {self.rows} of {self.height} rows")
+        self.add(self.compress.flush())
+        if self.pending:
+            self.chunk(b"IDAT", b"".join(self.pending))
+        self.chunk(b"IEND", b"")
+        self.file.close()
+        self.file = None
+        os.replace(self.partial, self.fn)
+
+    def abort(self):
+        """Drop the unfinished file after an error, keeping the last one."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -1,29 +1,41 @@
+from itertools import groupby
+from operator import itemgetter
+
 from db_config import get_connection
 
+ADJUST_BATCH = 1000
+
 
 def main():
+    # dbschema imports tilewriter, which imports this module
+    from dbschema import migrate
     conn = get_connection()
     cur = conn.cursor()
+    migrate(conn)
     sql = """\
         select rtno
         from regiontile
         -- where srno = 93
+        order by rtno
         """
     cur.execute(sql)
-    rows = cur.fetchall()
-    i = 0
-    for row in rows:
-        if i % 500 == 0:
-            print(i)
-        i += 1
-        tileadjust(cur, row["rtno"])
+    rtnos = [row["rtno"] for row in cur.fetchall()]
+    for i in range(0, len(rtnos), ADJUST_BATCH):
+        print(i)
+        tileadjust_many(cur, rtnos[i:i + ADJUST_BATCH])
         conn.commit()
-    print(i)
+    print(len(rtnos))
     # tileadjust(cur, 94594)
     # conn.commit()
 
 
 def tileadjust(cur, rtno):
+    tileadjust_many(cur, (rtno,))
+
+
+def tileadjust_many(cur, rtnos):
+    """Classify the componentterrain rows of many tiles with one select and
+    one update per batch of tiles."""
     # sql = """\
     #     # delete ct.*
     #     # from componentterrain as ct
@@ -39,27 +51,49 @@ def tileadjust(cur, rtno):
     #     """
     # prm = (rtno,)
     # cur.execute(sql, prm)
-    sql = """\
-        select ct.ctno, ct.terrainid, bs.spritecategory, ke.keno
-        from tilecomponent tc
-        inner join componentterrain ct
-            on ct.tcno = tc.tcno
-        inner join terraintexture tt
-            on tt.terrainid = ct.terrainid
-        inner join texturebitmap tb
-            on tb.ttno = tt.ttno
-        inner join bitmapsprites bs
-            on bs.texture = tb.texture
-            and bs.cx = tb.cx
-            and bs.cy = tb.cy
-        left join keepeffect ke
-            on ke.ctno = ct.ctno
-        where tc.rtno = %s
-        order by ct.ctno
-        """
-    prm = (rtno,)
-    cur.execute(sql, prm)
-    rows = cur.fetchall()
+    rtnos = sorted(set(rtnos))
+    for i in range(0, len(rtnos), ADJUST_BATCH):
+        sql = """\
+            select tc.rtno, ct.ctno, ct.terrainid, bs.spritecategory, ke.keno
+            from tilecomponent tc
+            inner join componentterrain ct
+                on ct.tcno = tc.tcno
+            inner join terraintexture tt
+                on tt.terrainid = ct.terrainid
+            inner join texturebitmap tb
+                on tb.ttno = tt.ttno
+            inner join bitmapsprites bs
+                on bs.texture = tb.texture
+                and bs.cx = tb.cx
+                and bs.cy = tb.cy
+            left join keepeffect ke
+                on ke.ctno = ct.ctno
+            where tc.rtno = any(%s)
+            order by tc.rtno, ct.ctno
+            """
+        prm = (rtnos[i:i + ADJUST_BATCH],)
+        cur.execute(sql, prm)
+        updates = []
+        for _, rows in groupby(cur.fetchall(), key=itemgetter("rtno")):
+            updates.extend(classify(list(rows)))
+        tcnos = update_componentterrain_many(cur, updates)
+        if tcnos:
+            # Stamp the tiles whose map image changed
+            sql = """\
+                update regiontile
+                set generation = nextval('tilegeneration')
+                where rtno in (
+                    select rtno
+                    from tilecomponent
+                    where tcno = any(%s))
+                """
+            cur.execute(sql, (tcnos,))
+
+
+def classify(rows):
+    """Work out base, wall and door for the componentterrain rows of one
+    tile. Returns a list of (ctno, base, wall, door)."""
+    updates = []
 
     # -- 7 dark, 131 web, 134 icestorm, 135 fireball
     # -- 187 poison cloud, 188 lightning, 340 concussion
@@ -170,7 +204,7 @@ def tileadjust(cur, rtno):
     for row in rows:
         if (row["ctno"] != ctno
         and ctno):
-            update_componentterrain(cur, ctno, base, wall, door)
+            updates.append((ctno, base, wall, door))
         if (row["ctno"] != ctno
         or not ctno):
             ctno = row["ctno"]
@@ -299,17 +333,34 @@ def tileadjust(cur, rtno):
         else:
             base |= 1
 
-    update_componentterrain(cur, ctno, base, wall, door)
+    if ctno:
+        updates.append((ctno, base, wall, door))
+    return updates
 
 
 def update_componentterrain(cur, ctno, base, wall, door):
+    update_componentterrain_many(cur, ((ctno, base, wall, door),))
+
+
+def update_componentterrain_many(cur, updates):
+    """Apply [(ctno, base, wall, door)] with a single update. Rows that
+    already hold those values are left alone. Returns the tcnos of the
+    rows that changed."""
+    if not updates:
+        return []
     sql = """\
-        update componentterrain
-        set base = %s, wall =  %s, door = %s
-        where ctno = %s
+        update componentterrain as ct
+        set base = v.base, wall = v.wall, door = v.door
+        from unnest(%s::integer[], %s::smallint[],
+            %s::smallint[], %s::smallint[]) as v (ctno, base, wall, door)
+        where ct.ctno = v.ctno
+        and (ct.base, ct.wall, ct.door)
+            is distinct from (v.base, v.wall, v.door)
+        returning ct.tcno
         """
-    prm = (base, wall, door, ctno)
+    prm = tuple(map(list, zip(*updates)))
     cur.execute(sql, prm)
+    return sorted({row["tcno"] for row in cur.fetchall()})
 
 
 if __name__ == "__main__":
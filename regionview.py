@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import bitmapfiles
+
+COMPOSED_LIMIT = 2000  # composed tiles kept
+
+
+class RegionView:
+    """Renders map views of the region a TileWriter is loading, from the
+    visible terrains the writer keeps in memory.
+
+    The sprites of every terrain are read once. Tiles are composed with
+    bitmapfiles.compose_tile and cached by their sprite stack, so a tile
+    seen at an earlier transition is pasted without composing it again.
+    render() runs on a single background thread; view() takes its
+    snapshot of the writer on the calling thread first."""
+
+    def __init__(self, conn):
+        self.terrains = {}  # terrainid -> [(render, sprite args)]
+        self.composed = bitmapfiles.ComposeCache(COMPOSED_LIMIT)
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        sql = """\
+            select tt.terrainid, bs.render,
+                tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy
+            from terraintexture as tt
+            inner join texturebitmap as tb
+                on tb.ttno = tt.ttno
+            inner join bitmapsprites as bs
+                on bs.texture = tb.texture
+                and bs.cx = tb.cx
+                and bs.cy = tb.cy
+            """
+        cur = conn.cursor()
+        cur.execute(sql)
+        for row in cur.fetchall():
+            self.terrains.setdefault(row["terrainid"], []).append(
+                (row["render"], (row["texture"], row["cx"], row["cy"],
+                row["sx"], row["sy"], row["ox"], row["oy"])))
+        conn.commit()
+
+    def stack(self, visible):
+        """Sprite stack of a tile, in the order the map query pastes it:
+        by render, then by component."""
+        layers = []
+        for tcno, terrainid, color in visible:
+            for render, sprite in self.terrains.get(terrainid, ()):
+                layers.append((render, tcno, sprite + (color,)))
+        layers.sort(key=lambda layer: layer[:2])
+        return tuple(sprite for _, _, sprite in layers)
+
+    def view(self, visible, tlx, tly, brx, bry, fn=None):
+        """Start rendering tiles tlx, tly to brx, bry from the visible dict
+        of a TileWriter. Returns a Future of the image."""
+        stacks = {}
+        for tx in range(tlx, brx + 1):
+            for ty in range(tly, bry + 1):
+                stack = self.stack(visible.get((tx, ty), ()))
+                if stack:
+                    stacks[(tx, ty)] = stack
+        return self.pool.submit(self.render, stacks, tlx, tly, brx, bry, fn)
+
+    def render(self, stacks, tlx, tly, brx, bry, fn=None):
+        sx = (brx - tlx + 1) * 110 + 90
+        sy = (bry - tly + 1) * 110 + 90
+        new = Image.new(mode="RGBA", size=(sx, sy), color=(0, 0, 0, 0))
+        for (tx, ty), stack in sorted(stacks.items()):
+            image, coverage = self.composed.get(stack)
+            bitmapfiles.paste_tile(new, image, coverage,
+                (tx - tlx) * 110, (ty - tly) * 110)
+
+        # Crop off the extra padding
+        new = new.crop((0, 0, sx - 90, sy - 90))
+        if fn:
+            new.save(fn)
+        return new
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,327 @@
+from array import array
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+# A move frame is 00 00 3D 00, the direction, 08 and an 8 byte mask with
+# one bit per tile of the 8x8 view that follows in the payload.
+MOVE_FRAME = re.compile(rb"\x00\x00\x3d\x00.\x08", re.DOTALL)
+FRAME_SIZE = 14
+TRANSITION_MASK = bytes.fromhex("FFFFFFFFFFFFFFFF")
+NO_COLOR = bytes.fromhex("FFFFFFFF")
+
+# tiletype flags
+TILE_VALID = 0x01
+TILE_TERRAIN = 0x02  # tile carries a terrain list
+TILE_COLOR = 0x04  # every terrain id is followed by a color
+TILE_MOVECOST = 0x08  # terrain list is followed by a movecost byte
+
+LOG_MAGIC = b"SRLOG"
+LOG_VERSION = 1
+LOG_SUFFIX = ".decoded"
+
+Move = namedtuple("Move", "move offset direction mask tiles")
+Tile = namedtuple("Tile", "dx dy tiletype terrainlist movecost")
+
+
+def build_tiletypes():
+    """256 entry lookup table of tiletype flags, indexed by tiletype."""
+    table = bytearray(256)
+    for tiletype in (
+        0x00, 0x02, 0x04, 0x05, 0x06, 0x07,
+        0x08, 0x0A, 0x0C, 0x0D, 0x0E, 0x0F,
+        0x12, 0x16, 0x17, 0x1A, 0x1E, 0x1F,
+        0x22, 0x26, 0x27, 0x2A, 0x2E, 0x2F,
+        0x45, 0x47, 0x4D, 0x4F,
+        0x57, 0x5F,
+        0x67, 0x6F
+    ):
+        table[tiletype] |= TILE_VALID | TILE_TERRAIN
+    for tiletype in (
+        0x00, 0x02, 0x08, 0x0A,
+        0x12, 0x1A,
+        0x22, 0x2A
+    ):
+        table[tiletype] &= ~TILE_TERRAIN
+    for tiletype in (
+        0x0C, 0x0D, 0x0E, 0x0F,
+        0x1E, 0x1F,
+        0x2E, 0x2F,
+        0x4D, 0x4F,
+        0x5F,
+        0x6F
+    ):
+        table[tiletype] |= TILE_COLOR
+    for tiletype in (
+        0x05, 0x0D,
+        0x45, 0x4D
+    ):
+        table[tiletype] |= TILE_MOVECOST
+    return bytes(table)
+
+
+TILETYPES = build_tiletypes()
+
+
+def open_replay(fn):
+    """Map a replay file read only. The mapping outlives the file handle."""
+    with open(fn, "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_moves(data):
+    """Yield every move frame in the replay with its decoded tiles.
+
+    Scanning resumes after each decoded payload, so tile data is never
+    mistaken for a move frame. Transition moves (all FF mask) carry no
+    tiles and yield tiles=None."""
+    search = MOVE_FRAME.search
+    last = len(data) - FRAME_SIZE - 1
+    pos = 0
+    move = 0
+    while True:
+        frame = search(data, pos)
+        if frame is None:
+            break
+        offset = frame.start()
+        if offset > last:
+            break
+        direction = data[offset + 4]
+        mask = bytes(data[offset + 6:offset + FRAME_SIZE])
+        pos = offset + FRAME_SIZE
+        move += 1
+        if mask == TRANSITION_MASK:
+            yield Move(move, offset, direction, mask, None)
+            continue
+        try:
+            tiles, pos = decode_tiles(data, pos, mask)
+        except (IndexError, struct.error):
+            msg = f"Truncated move {move} at {offset:06X}"
+            raise ValueError(msg) from None
+        yield Move(move, offset, direction, mask, tiles)
+
+
+def decode_tiles(data, index, mask):
+    """Decode the payload of one move starting at index.
+
+    Returns the tiles and the index just past the payload. Tile dx, dy are
+    relative to the player, who stands at (3, 3) of the 8x8 view."""
+    tiles = []
+    unpack_terrainid = struct.Struct("<H").unpack_from
+    for dy, m in enumerate(mask, -3):
+        if not m:
+            continue
+        for dx in range(-3, 5):
+            if not m & 1 << dx + 3:
+                continue
+
+            tiletype = data[index]
+            flags = TILETYPES[tiletype]
+            if not flags & TILE_VALID:
+                msg = f"Bad tiletype {tiletype:02X}: " + \
+                    " ".join(f"{x:02X}"
+                        for x in data[index + 1:index + 21])
+                raise ValueError(msg)
+            index += 1
+
+            if not flags & TILE_TERRAIN:
+                tiles.append(Tile(dx, dy, tiletype, None, None))
+                continue
+
+            terrcnt = data[index]
+            index += 1
+            terrainlist = []
+            for _ in range(terrcnt):
+                terrainid, = unpack_terrainid(data, index)
+                index += 2
+                color = "-"
+                if flags & TILE_COLOR:
+                    rgba = data[index:index + 4]
+                    index += 4
+                    if len(rgba) < 4:
+                        raise IndexError(index)
+                    if rgba != NO_COLOR:
+                        color = ", ".join(f"{c}" for c in rgba)
+                terrainlist.append((terrainid, color))
+
+            movecost = None
+            if flags & TILE_MOVECOST:
+                movecost = data[index]
+                index += 1
+            tiles.append(Tile(dx, dy, tiletype, terrainlist, movecost))
+    return tiles, index
+
+
+class MoveLog:
+    """Compact, array backed log of the decoded moves of one replay.
+
+    Moves index into the tile arrays and tiles index into the terrain
+    arrays, so a log holds no Python objects per tile. moves() rebuilds
+    the Move and Tile tuples that iter_moves yields."""
+
+    ARRAYS = (
+        # moves
+        ("move_offset", "Q"),
+        ("move_direction", "B"),
+        ("move_mask", "B"),  # 8 per move
+        ("move_tile", "I"),  # first tile of the move
+        # tiles
+        ("tile_dx", "b"),
+        ("tile_dy", "b"),
+        ("tile_type", "B"),
+        ("tile_movecost", "h"),  # -1 = none
+        ("tile_terrain", "I"),  # first terrain of the tile
+        # terrains
+        ("terrain_id", "H"),
+        ("terrain_color", "I"),  # packed RGBA, FFFFFFFF = no color
+    )
+
+    def __init__(self, digest=b"", size=0):
+        self.digest = digest  # sha256 of the replay file
+        self.size = size
+        self.error = ""  # decode error after the last move, if any
+        self.fn = ""  # replay file, not saved
+        for name, typecode in self.ARRAYS:
+            setattr(self, name, array(typecode))
+        self.colors = {"-": 0xFFFFFFFF}
+
+    def __len__(self):
+        return len(self.move_offset)
+
+    def is_transition(self, i):
+        return self.move_mask[i * 8:i * 8 + 8].tobytes() == TRANSITION_MASK
+
+    def append(self, move):
+        self.move_offset.append(move.offset)
+        self.move_direction.append(move.direction)
+        self.move_mask.frombytes(move.mask)
+        self.move_tile.append(len(self.tile_type))
+        for tile in move.tiles or ():
+            self.tile_dx.append(tile.dx)
+            self.tile_dy.append(tile.dy)
+            self.tile_type.append(tile.tiletype)
+            self.tile_movecost.append(
+                -1 if tile.movecost is None else tile.movecost)
+            self.tile_terrain.append(len(self.terrain_id))
+            for terrainid, color in tile.terrainlist or ():
+                packed = self.colors.get(color)
+                if packed is None:
+                    packed = int.from_bytes(
+                        bytes(map(int, color.split(", "))), "big")
+                    self.colors[color] = packed
+                self.terrain_id.append(terrainid)
+                self.terrain_color.append(packed)
+
+    def moves(self, start=0):
+        """Yield the logged moves from move index start on."""
+        colors = {packed: color for color, packed in self.colors.items()}
+        move_tile = self.move_tile
+        tile_terrain = self.tile_terrain
+        tile_count = len(self.tile_type)
+        terrain_count = len(self.terrain_id)
+        for i in range(start, len(self)):
+            mask = self.move_mask[i * 8:i * 8 + 8].tobytes()
+            tiles = None
+            if mask != TRANSITION_MASK:
+                tiles = []
+                end = move_tile[i + 1] if i + 1 < len(self) else tile_count
+                for t in range(move_tile[i], end):
+                    tiletype = self.tile_type[t]
+                    terrainlist = None
+                    if TILETYPES[tiletype] & TILE_TERRAIN:
+                        last = (tile_terrain[t + 1] if t + 1 < tile_count
+                            else terrain_count)
+                        terrainlist = []
+                        for c in range(tile_terrain[t], last):
+                            packed = self.terrain_color[c]
+                            color = colors.get(packed)
+                            if color is None:
+                                color = ", ".join(
+                                    f"{b}" for b in packed.to_bytes(4, "big"))
+                                colors[packed] = color
+                            terrainlist.append((self.terrain_id[c], color))
+                    movecost = self.tile_movecost[t]
+                    tiles.append(Tile(self.tile_dx[t], self.tile_dy[t],
+                        tiletype, terrainlist,
+                        None if movecost < 0 else movecost))
+            yield Move(i + 1, self.move_offset[i], self.move_direction[i],
+                mask, tiles)
+
+    def save(self, fn):
+        error = self.error.encode()
+        with open(fn, "wb") as file:
+            file.write(LOG_MAGIC)
+            file.write(struct.pack("<HB32sQI", LOG_VERSION,
+                sys.byteorder == "little", self.digest, self.size, len(error)))
+            file.write(error)
+            for name, _ in self.ARRAYS:
+                values = getattr(self, name)
+                file.write(struct.pack("<Q", len(values)))
+                values.tofile(file)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, "rb") as file:
+            if file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError(f"{fn} is not a decoded replay log")
+            header = struct.Struct("<HB32sQI")
+            version, little, digest, size, errlen = header.unpack(
+                file.read(header.size))
+            if version != LOG_VERSION:
+                raise ValueError(f"{fn} has log version {version}")
+            log = cls(digest, size)
+            log.error = file.read(errlen).decode()
+            for name, _ in cls.ARRAYS:
+                values = getattr(log, name)
+                count, = struct.unpack("<Q", file.read(8))
+                values.fromfile(file, count)
+                if little != (sys.byteorder == "little"):
+                    values.byteswap()
+        return log
+
+
+def decode_replay(data):
+    """Decode a whole replay into a MoveLog.
+
+    A decode error ends the log instead of raising, so the moves before
+    it can still be applied. The error is kept in log.error."""
+    log = MoveLog(hashlib.sha256(data).digest(), len(data))
+    try:
+        for move in iter_moves(data):
+            log.append(move)
+    except ValueError as e:
+        log.error = str(e)
+    return log
+
+
+def decoded_replay(fn, redecode=False):
+    """Return the MoveLog of a replay file.
+
+    The log is saved next to the replay and reused while the replay
+    content is unchanged."""
+    data = open_replay(fn)
+    digest = hashlib.sha256(data).digest()
+    logfn = fn + LOG_SUFFIX
+    if (not redecode
+    and os.path.exists(logfn)):
+        try:
+            log = MoveLog.load(logfn)
+        except (OSError, ValueError, EOFError, struct.error):
+            log = None
+        if (log is not None
+        and log.digest == digest):
+            log.fn = fn
+            return log
+    log = decode_replay(data)
+    log.fn = fn
+    try:
+        log.save(logfn)
+    except OSError as e:
+        print(f"Could not save {logfn}: {e}")
+    return log
@@ -0,0 +1,162 @@
+import struct
+import sys
+from collections import deque
+
+# Trace levels, each includes the ones before it
+OFF = 0
+MOVES = 1
+TILES = 2
+BYTES = 3
+LEVELS = {"off": OFF, "moves": MOVES, "tiles": TILES, "bytes": BYTES}
+
+# Binary trace records, each starts with its kind byte
+MOVE = 1
+TRANSITION = 2
+TILE = 3
+RAW = 4
+RECORDS = {
+    MOVE: struct.Struct("<BIiiBQ8s"),
+    TRANSITION: struct.Struct("<BIiiiiB"),
+    TILE: struct.Struct("<BiiBhh"),  # count -1 = no terrain list
+    RAW: struct.Struct("<BQI"),
+}
+TERRAIN = struct.Struct("<HI")
+
+
+class Tracer:
+    """Level gated replay trace.
+
+    Records are kept as tuples in a bounded ring buffer and only formatted
+    when the ring is dumped, normally after an error. With a trace file
+    every record is also written out, as text or, for a .bin file, in a
+    compact binary format that format_binary() turns back into text.
+    Callers check level before building a record, so a level that is off
+    costs one comparison."""
+
+    def __init__(self, level=TILES, ring=10000, fn=None):
+        self.level = level
+        self.ring = deque(maxlen=ring)
+        self.file = None
+        self.binary = False
+        if fn and level:
+            self.binary = fn.endswith(".bin")
+            self.file = open(fn, "wb" if self.binary else "w")
+
+    def record(self, record):
+        self.ring.append(record)
+        if self.file:
+            if self.binary:
+                self.file.write(pack_record(record))
+            else:
+                print(format_record(record), file=self.file)
+
+    def move(self, move, px, py):
+        self.record((MOVE, move.move, px, py, move.direction, move.offset,
+            move.mask))
+
+    def transition(self, move, sid, rid, px, py):
+        self.record((TRANSITION, move.move, sid, rid, px, py, move.direction))
+
+    def tile(self, tx, ty, tile):
+        self.record((TILE, tx, ty, tile.tiletype, tile.terrainlist,
+            tile.movecost))
+
+    def raw(self, offset, payload):
+        self.record((RAW, offset, bytes(payload)))
+
+    def dump(self, fn, error=None):
+        """Write the ring buffer as text, followed by the error if given."""
+        with open(fn, "w") as file:
+            for record in self.ring:
+                print(format_record(record), file=file)
+            if error is not None:
+                print(error, file=file)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def format_record(record):
+    kind = record[0]
+    if kind == MOVE:
+        _, moveno, px, py, direction, offset, mask = record
+        return (f"move:{moveno} px:{px} py:{py} dir:{direction:2X}"
+            f" m:{mask.hex().upper()} index:{offset:06X}")
+    if kind == TRANSITION:
+        _, moveno, sid, rid, px, py, direction = record
+        return (f"move:{moveno} sid:{sid}, rid:{rid}, px:{px}, py:{py}"
+            f" dir:{direction:2X}")
+    if kind == TILE:
+        _, tx, ty, tiletype, terrainlist, movecost = record
+        text = f"  tx:{tx} ty:{ty} type:{tiletype:02X}"
+        if terrainlist is not None:
+            text += f" count:{len(terrainlist):02X}"
+            for terrainid, color in terrainlist:
+                text += f" tid:{terrainid}"
+                if color != "-":
+                    text += f" color:{color}"
+        if movecost is not None:
+            text += f" move:{movecost:02X}"
+        return text
+    _, offset, payload = record
+    return f"  bytes:{offset:06X} " + " ".join(f"{b:02X}" for b in payload)
+
+
+def pack_record(record):
+    kind = record[0]
+    if kind == MOVE:
+        _, moveno, px, py, direction, offset, mask = record
+        return RECORDS[MOVE].pack(kind, moveno, px, py, direction, offset, mask)
+    if kind == TRANSITION:
+        return RECORDS[TRANSITION].pack(*record)
+    if kind == TILE:
+        _, tx, ty, tiletype, terrainlist, movecost = record
+        count = -1 if terrainlist is None else len(terrainlist)
+        packed = RECORDS[TILE].pack(kind, tx, ty, tiletype, count,
+            -1 if movecost is None else movecost)
+        for terrainid, color in terrainlist or ():
+            packed += TERRAIN.pack(terrainid, 0xFFFFFFFF if color == "-"
+                else int.from_bytes(bytes(map(int, color.split(", "))), "big"))
+        return packed
+    _, offset, payload = record
+    return RECORDS[RAW].pack(kind, offset, len(payload)) + payload
+
+
+def read_binary(fn):
+    """Yield the records of a binary trace file."""
+    with open(fn, "rb") as file:
+        data = file.read()
+    index = 0
+    while index < len(data):
+        kind = data[index]
+        record = RECORDS[kind].unpack_from(data, index)
+        index += RECORDS[kind].size
+        if kind in (MOVE, TRANSITION):
+            yield record
+        elif kind == TILE:
+            _, tx, ty, tiletype, count, movecost = record
+            terrainlist = None
+            if count >= 0:
+                terrainlist = []
+                for _ in range(count):
+                    terrainid, color = TERRAIN.unpack_from(data, index)
+                    index += TERRAIN.size
+                    terrainlist.append((terrainid, "-" if color == 0xFFFFFFFF
+                        else ", ".join(f"{c}" for c in color.to_bytes(4, "big"))))
+            yield (kind, tx, ty, tiletype, terrainlist,
+                None if movecost < 0 else movecost)
+        else:
+            _, offset, length = record
+            yield (kind, offset, data[index:index + length])
+            index += length
+
+
+def format_binary(fn):
+    for record in read_binary(fn):
+        print(format_record(record))
+
+
+if __name__ == "__main__":
+    format_binary(sys.argv[1])
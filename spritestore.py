@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import os
+
+from PIL import Image
+
+import bitmapfiles
+
+SPRITE_BYTES = 200 * 200 * 4  # a finished RGBA sprite
+
+
+def sprite_keys(conn, srnos, limit=None):
+    """The distinct extract_sprite arguments (texture, cx, cy, sx, sy, ox,
+    oy, color) of the sprites visible in the regions srnos, the limit most
+    used of them when limit is given."""
+    sql = """\
+        select tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy, tc.color
+        from regiontile as rt
+        inner join tilecomponent as tc
+            on tc.rtno = rt.rtno
+        inner join componentterrain as ct
+            on ct.tcno = tc.tcno
+        inner join terraintexture as tt
+            on tt.terrainid = ct.terrainid
+        inner join texturebitmap as tb
+            on tb.ttno = tt.ttno
+        inner join bitmapsprites as bs
+            on bs.texture = tb.texture
+            and bs.cx = tb.cx
+            and bs.cy = tb.cy
+        where rt.srno = any(%s)
+        and ct.visible
+        group by tb.texture, tb.cx, tb.cy, tb.sx, tb.sy, tb.ox, tb.oy, tc.color
+        order by count(*) desc
+        limit %s
+        """
+    cur = conn.cursor()
+    cur.execute(sql, (list(srnos), limit))
+    keys = [(row["texture"], row["cx"], row["cy"], row["sx"], row["sy"],
+        row["ox"], row["oy"], row["color"])
+        for row in cur.fetchall()]
+    conn.commit()
+    return keys
+
+
+class SpriteStore:
+    """Finished sprites, cropped, tinted, offset and resized once into a
+    shared memory block, so render processes read them in place instead
+    of each making them again from the unxnb textures.
+
+    The parent creates the store and passes name and index to its
+    workers, which attach and install it into bitmapfiles. Sprites not in
+    the store are made by each process as before. Sprites are
+    keyed by their extract_sprite arguments as in bitmapfiles.extracted;
+    index maps each key to the offset of its 200x200 RGBA bytes."""
+
+    def __init__(self, shm, index):
+        self.shm = shm
+        self.index = index
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @classmethod
+    def create(cls, keys, workers=None):
+        """Make the sprites of keys on workers threads of this process."""
+        keys = list(dict.fromkeys(keys))
+        shm = shared_memory.SharedMemory(create=True,
+            size=max(len(keys) * SPRITE_BYTES, 1))
+
+        def make(slot):
+            sprite = bitmapfiles.make_sprite(*keys[slot])
+            # Other modes are left to bitmapfiles to make as before
+            if sprite.mode != "RGBA":
+                return None
+            offset = slot * SPRITE_BYTES
+            shm.buf[offset:offset + SPRITE_BYTES] = sprite.tobytes()
+            return offset
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            offsets = list(pool.map(make, range(len(keys))))
+        # The parent draws nothing itself
+        bitmapfiles.bitmaps.clear()
+        bitmapfiles.sprites.clear()
+        index = {key: offset for key, offset in zip(keys, offsets)
+            if offset is not None}
+        return cls(shm, index)
+
+    @classmethod
+    def attach(cls, name, index):
+        return cls(shared_memory.SharedMemory(name=name), index)
+
+    def install(self):
+        """Put the stored sprites into bitmapfiles as images over the
+        shared memory, so extract_sprite finds them there."""
+        for key, offset in self.index.items():
+            view = self.shm.buf[offset:offset + SPRITE_BYTES]
+            bitmapfiles.shared[key] = Image.frombuffer("RGBA", (200, 200),
+                view, "raw", "RGBA", 0, 1)
+
+    def unlink(self):
+        """Free the block, once the workers using it have exited."""
+        self.shm.close()
+        self.shm.unlink()
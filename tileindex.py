@@ -0,0 +1,187 @@
+from collections import Counter
+
+from db_config import get_connection
+from tilewriter import fingerprint, update_fingerprints
+from tilewriter import advisory_lock, LOCK_REGION
+from dbschema import migrate
+
+# Neighbourhoods are the 3x3 tiles around a tile
+NEIGHBOURS = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+MAX_LOCATIONS = 8  # a neighbourhood found more often than this is ignored
+MIN_VOTES = 8  # neighbourhoods that must agree on a match
+MATCH_MOVES = 20  # moves after a transition used to match
+
+
+def neighbourhood(grid, tx, ty):
+    """Hash of the fingerprints of the 3x3 tiles around tx, ty, or None
+    when one of them is not in grid."""
+    fps = []
+    for dx, dy in NEIGHBOURS:
+        fp = grid.get((tx + dx, ty + dy))
+        if fp is None:
+            return None
+        fps.append(fp)
+    return hash(tuple(fps))
+
+
+class TileIndex:
+    """Index of every stored tile by the fingerprints of its neighbourhood.
+
+    A lookup is one dict access whatever the number of segments. Common
+    neighbourhoods, like open floor, say nothing about where they are and
+    are dropped once they are found more than MAX_LOCATIONS times.
+
+    Tiles written after the index is built are added with update()."""
+
+    def __init__(self, conn):
+        self.locations = {}  # neighbourhood -> [(srno, tx, ty)], None = common
+        self.regions = {}  # srno -> (segmentid, regionid)
+        self.grids = {}  # srno -> {(tx, ty): fingerprint}
+        self.keys = {}  # (srno, tx, ty) -> neighbourhood it is listed under
+        cur = conn.cursor()
+        sql = """\
+            select sr.srno, s.segmentid, sr.regionid
+            from segmentregion sr
+            inner join segment s
+                on s.sno = sr.sno
+            """
+        cur.execute(sql)
+        for row in cur.fetchall():
+            self.regions[row["srno"]] = (row["segmentid"], row["regionid"])
+
+        sql = """\
+            select srno, tx, ty, fingerprint
+            from regiontile
+            where fingerprint is not null
+            order by srno
+            """
+        cur.execute(sql)
+        for row in cur.fetchall():
+            self.grids.setdefault(row["srno"], {})[(row["tx"], row["ty"])] = \
+                row["fingerprint"]
+        conn.commit()
+        for srno, grid in self.grids.items():
+            for tx, ty in grid:
+                self.add(srno, tx, ty)
+
+    def add(self, srno, tx, ty):
+        key = neighbourhood(self.grids[srno], tx, ty)
+        if key is None:
+            return
+        locations = self.locations.setdefault(key, [])
+        if locations is None:
+            return
+        if len(locations) >= MAX_LOCATIONS:
+            self.locations[key] = None
+            return
+        locations.append((srno, tx, ty))
+        self.keys[(srno, tx, ty)] = key
+
+    def remove(self, srno, tx, ty):
+        locations = self.locations.get(self.keys.pop((srno, tx, ty), None))
+        if locations:
+            locations.remove((srno, tx, ty))
+
+    def update(self, srno, fingerprints):
+        """Add the fingerprints {(tx, ty): fingerprint} of tiles written to
+        a region, listing again the neighbourhoods they are part of."""
+        grid = self.grids.setdefault(srno, {})
+        changed = set()
+        for (tx, ty), fp in fingerprints.items():
+            if grid.get((tx, ty)) == fp:
+                continue
+            grid[(tx, ty)] = fp
+            for dx, dy in NEIGHBOURS:
+                changed.add((tx + dx, ty + dy))
+        for tx, ty in changed:
+            if (tx, ty) in grid:
+                self.remove(srno, tx, ty)
+                self.add(srno, tx, ty)
+
+    def match(self, grid):
+        """Vote on where a grid of tile fingerprints, relative to an
+        unknown position, lies among the stored regions.
+
+        Returns [(votes, srno, ox, oy)] best first, where ox, oy is the
+        stored position of grid position 0, 0."""
+        votes = Counter()
+        for rx, ry in grid:
+            locations = self.locations.get(neighbourhood(grid, rx, ry))
+            for srno, tx, ty in locations or ():
+                votes[(srno, tx - rx, ty - ry)] += 1
+        return [(count, srno, ox, oy)
+            for (srno, ox, oy), count in votes.most_common()]
+
+    def best(self, grid):
+        """The match of a grid when it is clear, as (matches, unique).
+
+        unique is True when the best match has MIN_VOTES and twice the
+        votes of the next one."""
+        matches = self.match(grid)
+        unique = bool(matches
+            and matches[0][0] >= MIN_VOTES
+            and (len(matches) == 1 or matches[0][0] >= 2 * matches[1][0]))
+        return matches, unique
+
+
+def moves_grid(moves):
+    """Fingerprints of the tiles seen in the moves after a transition,
+    keyed by position relative to where the transition left the player.
+    Like a stored tile, a tile seen more than once is fingerprinted with
+    the terrains of every sighting."""
+    content = {}
+    px = 0
+    py = 0
+    for move in moves:
+        if move.tiles is None:
+            break
+        px += (move.direction & 0x0f) - 4
+        py += (move.direction >> 4 & 0x0f) - 4
+        for tile in move.tiles:
+            if tile.terrainlist is not None:
+                content.setdefault((px + tile.dx, py + tile.dy),
+                    set()).update(tile.terrainlist)
+    return {position: fingerprint(terrains)
+        for position, terrains in content.items()}
+
+
+def main():
+    """Fill in the fingerprints of tiles stored before they existed."""
+    conn = get_connection()
+    cur = conn.cursor()
+    migrate(conn)
+    sql = """\
+        select distinct srno
+        from regiontile
+        where fingerprint is null
+        order by srno
+        """
+    cur.execute(sql)
+    srnos = [row["srno"] for row in cur.fetchall()]
+    for srno in srnos:
+        sql = """\
+            select rt.rtno, ct.terrainid, tc.color
+            from regiontile rt
+            left join tilecomponent tc
+                on tc.rtno = rt.rtno
+            left join componentterrain ct
+                on ct.tcno = tc.tcno
+            where rt.srno = %s
+            and rt.fingerprint is null
+            order by rt.rtno
+            """
+        cur.execute(sql, (srno,))
+        content = {}
+        for row in cur.fetchall():
+            terrains = content.setdefault(row["rtno"], [])
+            if row["terrainid"] is not None:
+                terrains.append((row["terrainid"], row["color"]))
+        advisory_lock(cur, LOCK_REGION, srno)
+        update_fingerprints(cur, [(rtno, fingerprint(terrains))
+            for rtno, terrains in content.items()])
+        conn.commit()
+        print(f"srno {srno}: {len(content)} tiles")
+
+
+if __name__ == "__main__":
+    main()
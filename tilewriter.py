@@ -0,0 +1,347 @@
+import hashlib
+
+from regiontiles import tileadjust_many
+
+# Advisory lock classes, the second lock key is the srno or sno
+LOCK_REGION = 1  # tile rows of a segment region
+LOCK_SEGMENT = 2  # segmentregion rows of a segment
+LOCK_SCHEMA = 3  # schema migrations of dbschema
+
+
+def advisory_lock(cur, lockclass, key=0):
+    """Take a transaction level advisory lock, released at commit."""
+    sql = """\
+        select pg_advisory_xact_lock(%s, %s)
+        """
+    cur.execute(sql, (lockclass, key))
+
+
+def fingerprint(terrainlist):
+    """Signed 64 bit hash of the (terrainid, color) set of a tile.
+
+    Order and repeats do not count and terrainid may be a digit string,
+    so mapproj and replay tiles with the same content match."""
+    content = sorted({(color, int(terrainid)) for terrainid, color in terrainlist})
+    text = ";".join(f"{color}|{terrainid}" for color, terrainid in content)
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def update_fingerprints(cur, fingerprints):
+    """Store [(rtno, fingerprint)] with a single update."""
+    if not fingerprints:
+        return
+    rtnos, values = zip(*fingerprints)
+    sql = """\
+        update regiontile rt
+        set fingerprint = v.fingerprint
+        from unnest(%s::integer[], %s::bigint[]) as v(rtno, fingerprint)
+        where rt.rtno = v.rtno
+        """
+    cur.execute(sql, (list(rtnos), list(values)))
+
+
+class TileWriter:
+    """Write-behind buffer for regiontile, tilecomponent and
+    componentterrain rows.
+
+    Tiles are gathered by their natural key (srno, tx, ty, color, terrainid)
+    and written set based at flush time: the buffer is copied into a
+    temporary staging table and each table gets one insert of the rows it
+    is missing. flush() commits, so a flush is also the commit interval.
+
+    The ids of the current region are cached, so tiles that are already
+    stored are answered in memory and never buffered. Tiles that got new
+    rows are kept in a dirty set and adjusted once per flush.
+
+    Each tile also keeps the fingerprints of terrain lists known to be
+    stored, starting with regiontile.fingerprint. A re-sighting with one
+    of them is skipped without looking at its terrains.
+
+    With track_visible set, the writer also keeps the visible terrains of
+    each tile of the region, as set by tileadjust, for the transition
+    view of load replay.py.
+
+    Only one region is buffered at a time, so a flush writes a single
+    region and holds its LOCK_REGION advisory lock until it commits.
+    Writers in other processes wait for a region they share and run
+    alongside on any other region."""
+
+    def __init__(self, conn, flush_moves=0):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.flush_moves = flush_moves  # 0 = flush only when asked
+        self.rows = set()
+        self.dirty = set()  # rtnos waiting for tileadjust
+        self.moves = 0
+        self.staging = False
+        self.before_commit = None  # called with the cursor before a commit
+        # Called with the srno and {(tx, ty): fingerprint} of the tiles a
+        # flush wrote, once it has committed
+        self.written = None
+        self.fresh = {}
+
+        self.srno = None
+        self.tiles = {}  # (tx, ty) -> rtno
+        self.components = {}  # (rtno, color) -> tcno
+        self.terrains = set()  # (tcno, terrainid)
+        self.content = {}  # (tx, ty) -> set((terrainid, color)) stored
+        self.fingerprints = {}  # (tx, ty) -> set(fingerprint) stored
+        self.hashes = {}  # tuple(terrainlist) -> fingerprint
+        self.track_visible = False
+        self.visible = {}  # (tx, ty) -> [(tcno, terrainid, color)] shown
+
+    def load_region(self, srno):
+        """Preload the tile ids of a region into the cache."""
+        self.flush()
+        self.srno = srno
+        self.tiles = {}
+        self.components = {}
+        self.terrains = set()
+        self.content = {}
+        self.fingerprints = {}
+        self.visible = {}
+        sql = """\
+            select rt.rtno, rt.tx, rt.ty, rt.fingerprint, tc.tcno, tc.color,
+                ct.terrainid, ct.base, ct.wall, ct.door
+            from regiontile rt
+            left join tilecomponent tc
+                on tc.rtno = rt.rtno
+            left join componentterrain ct
+                on ct.tcno = tc.tcno
+            where rt.srno = %s
+            order by rt.rtno, tc.tcno, ct.ctno
+            """
+        self.cur.execute(sql, (srno,))
+        rows = self.cur.fetchall()
+        self.cache_rows(rows)
+        self.cache_visible(rows)
+        # Fill in the fingerprints of tiles stored before they existed
+        stored = {(row["tx"], row["ty"]): row["fingerprint"] for row in rows}
+        fingerprints = [(self.tiles[key], fp)
+            for key, fp in self.store_fingerprints(stored)
+            if fp != stored[key]]
+        if fingerprints:
+            advisory_lock(self.cur, LOCK_REGION, srno)
+            update_fingerprints(self.cur, fingerprints)
+        self.conn.commit()
+
+    def cache_rows(self, rows):
+        for row in rows:
+            key = (row["tx"], row["ty"])
+            rtno = self.tiles.setdefault(key, row["rtno"])
+            content = self.content.setdefault(key, set())
+            if row["tcno"] is None:
+                continue
+            tcno = self.components.setdefault((rtno, row["color"]), row["tcno"])
+            if row["terrainid"] is not None:
+                self.terrains.add((tcno, row["terrainid"]))
+                content.add((row["terrainid"], row["color"]))
+
+    def cache_visible(self, rows):
+        """Replace the visible terrains of the tiles in rows."""
+        for row in rows:
+            self.visible[(row["tx"], row["ty"])] = []
+        for row in rows:
+            if (row["terrainid"] is not None
+            and (row["base"] % 2
+            or row["wall"] % 2
+            or row["door"] % 2)):
+                self.visible[(row["tx"], row["ty"])].append(
+                    (row["tcno"], row["terrainid"], row["color"]))
+
+    def load_visible(self, rtnos):
+        sql = """\
+            select rt.tx, rt.ty, tc.tcno, tc.color, ct.terrainid,
+                ct.base, ct.wall, ct.door
+            from regiontile rt
+            inner join tilecomponent tc
+                on tc.rtno = rt.rtno
+            inner join componentterrain ct
+                on ct.tcno = tc.tcno
+            where rt.rtno = any(%s)
+            order by rt.rtno, tc.tcno, ct.ctno
+            """
+        self.cur.execute(sql, (sorted(rtnos),))
+        self.cache_visible(self.cur.fetchall())
+
+    def store_fingerprints(self, keys):
+        """Fingerprint the cached content of the tiles at keys and
+        remember it. Yields ((tx, ty), fingerprint)."""
+        for key in keys:
+            fp = fingerprint(self.content[key])
+            self.fingerprints.setdefault(key, set()).add(fp)
+            yield key, fp
+
+    def tile_fingerprint(self, terrainlist):
+        key = tuple(terrainlist)
+        fp = self.hashes.get(key)
+        if fp is None:
+            fp = fingerprint(terrainlist)
+            self.hashes[key] = fp
+        return fp
+
+    def region_tile(self, tx, ty):
+        return self.tiles.get((tx, ty))
+
+    def tile_component(self, rtno, color):
+        return self.components.get((rtno, color))
+
+    def component_terrain(self, tcno, terrainid):
+        return (tcno, terrainid) in self.terrains
+
+    def add_tile(self, srno, tx, ty, terrainlist):
+        if srno != self.srno:
+            self.load_region(srno)
+        fp = self.tile_fingerprint(terrainlist)
+        fingerprints = self.fingerprints.get((tx, ty))
+        if (fingerprints
+        and fp in fingerprints):
+            return
+        rtno = self.region_tile(tx, ty)
+        if rtno is None:
+            if not terrainlist:
+                self.rows.add((srno, tx, ty, None, None))
+            for terrainid, color in terrainlist:
+                self.rows.add((srno, tx, ty, color, terrainid))
+            return
+        stored = True
+        for terrainid, color in terrainlist:
+            tcno = self.tile_component(rtno, color)
+            if (tcno is None
+            or not self.component_terrain(tcno, terrainid)):
+                self.rows.add((srno, tx, ty, color, terrainid))
+                stored = False
+        if stored:
+            # A subset of the stored content, skip it from now on
+            self.fingerprints.setdefault((tx, ty), set()).add(fp)
+
+    def end_move(self):
+        self.moves += 1
+        if (self.flush_moves
+        and self.moves >= self.flush_moves):
+            self.flush()
+
+    def flush(self):
+        if (self.rows
+        or self.dirty):
+            advisory_lock(self.cur, LOCK_REGION, self.srno)
+        if self.rows:
+            self.write_rows()
+        if self.dirty:
+            tileadjust_many(self.cur, self.dirty)
+            if self.track_visible:
+                self.load_visible(self.dirty)
+            self.dirty = set()
+        if self.before_commit:
+            self.before_commit(self.cur)
+        self.conn.commit()
+        self.rows = set()
+        self.moves = 0
+        if self.fresh:
+            if self.written:
+                self.written(self.srno, self.fresh)
+            self.fresh = {}
+
+    def write_rows(self):
+        cur = self.cur
+        if not self.staging:
+            sql = """\
+                create temporary table if not exists stagetile
+                    (srno integer, tx integer, ty integer,
+                    color character varying, terrainid integer)
+                on commit delete rows
+                """
+            cur.execute(sql)
+            self.staging = True
+
+        sql = """\
+            copy stagetile (srno, tx, ty, color, terrainid)
+            from stdin
+            """
+        with cur.copy(sql) as copy:
+            for row in self.rows:
+                copy.write_row(row)
+
+        sql = """\
+            insert into regiontile
+                (srno, tx, ty)
+            select distinct s.srno, s.tx, s.ty
+            from stagetile s
+            where not exists (
+                select rt.rtno
+                from regiontile rt
+                where rt.srno = s.srno
+                and rt.tx = s.tx
+                and rt.ty = s.ty)
+            order by s.srno, s.tx, s.ty
+            """
+        cur.execute(sql)
+
+        sql = """\
+            insert into tilecomponent
+                (rtno, color)
+            select distinct rt.rtno, s.color collate "C"
+            from stagetile s
+            inner join regiontile rt
+                on rt.srno = s.srno
+                and rt.tx = s.tx
+                and rt.ty = s.ty
+            where s.color is not null
+            and not exists (
+                select tc.tcno
+                from tilecomponent tc
+                where tc.rtno = rt.rtno
+                and tc.color = s.color)
+            order by rt.rtno, s.color collate "C"
+            """
+        cur.execute(sql)
+
+        sql = """\
+            insert into componentterrain
+                (tcno, terrainid, base, wall, door)
+            select distinct tc.tcno, s.terrainid, 0, 0, 0
+            from stagetile s
+            inner join regiontile rt
+                on rt.srno = s.srno
+                and rt.tx = s.tx
+                and rt.ty = s.ty
+            inner join tilecomponent tc
+                on tc.rtno = rt.rtno
+                and tc.color = s.color
+            where not exists (
+                select ct.ctno
+                from componentterrain ct
+                where ct.tcno = tc.tcno
+                and ct.terrainid = s.terrainid)
+            order by tc.tcno, s.terrainid
+            """
+        cur.execute(sql)
+
+        # Read back the new ids for the cache
+        sql = """\
+            select distinct rt.rtno, rt.tx, rt.ty, tc.tcno, tc.color,
+                ct.terrainid
+            from stagetile s
+            inner join regiontile rt
+                on rt.srno = s.srno
+                and rt.tx = s.tx
+                and rt.ty = s.ty
+            left join tilecomponent tc
+                on tc.rtno = rt.rtno
+                and tc.color = s.color
+            left join componentterrain ct
+                on ct.tcno = tc.tcno
+                and ct.terrainid = s.terrainid
+            where s.srno = %s
+            order by rt.rtno, tc.tcno
+            """
+        cur.execute(sql, (self.srno,))
+        rows = cur.fetchall()
+        self.cache_rows(rows)
+        self.dirty.update(row["rtno"] for row in rows)
+        keys = {(row["tx"], row["ty"]) for row in rows}
+        fingerprints = dict(self.store_fingerprints(keys))
+        update_fingerprints(cur, [(self.tiles[key], fp)
+            for key, fp in fingerprints.items()])
+        self.fresh.update(fingerprints)